@@ -1,91 +1,23 @@
-import csv
-import heapq
-import os
-import json
 import matplotlib.pyplot as plt
 import geopandas as gpd
-import contextily as ctx
 import numpy as np
-from matplotlib.widgets import Slider, Button
-from pyproj import Transformer
-import pandas as pd
-import re
+from matplotlib.widgets import Slider, Button, TextBox
 from matplotlib.patches import FancyArrowPatch
 from matplotlib.colors import LinearSegmentedColormap
-import warnings
-
-
-# BRT station coordinates (WGS84)
-brt_stations = [
-    {"id": "brt_1", "lat": 42.314139, "lon": -71.791083},
-    {"id": "brt_2", "lat": 42.301139, "lon": -71.801972},
-    {"id": "brt_3", "lat": 42.276472, "lon": -71.801556},
-    {"id": "brt_4", "lat": 42.271686, "lon": -71.800596},
-    {"id": "brt_5", "lat": 42.264190, "lon": -71.795404},
-    {"id": "brt_6", "lat": 42.255527, "lon": -71.797340},
-    {"id": "brt_7", "lat": 42.241968, "lon": -71.801111},
-    {"id": "brt_8", "lat": 42.232811, "lon": -71.793633},
-    {"id": "brt_9", "lat": 42.268892, "lon": -71.842723},
-    {"id": "brt_10", "lat": 42.262146, "lon": -71.822375},
-    {"id": "brt_11", "lat": 42.248583, "lon": -71.829806},
-    {"id": "brt_12", "lat": 42.265997, "lon": -71.785728},
-    {"id": "brt_13", "lat": 42.276670, "lon": -71.763703}
-]
-brt_ids = [x['id'] for x in brt_stations]
-
-# Transform BRT station coordinates to map projection (EPSG:3857)
-transformer = Transformer.from_crs("epsg:4326", "epsg:3857", always_xy=True)
-brt_xy = [transformer.transform(station['lon'], station['lat']) for station in brt_stations]
-
-# State for BRT overlay
-overlay_brt = [False]
-
-# Load city boundary as a polygon
-city_gdf = gpd.read_file('city_boundary.geojson')
-city_gdf = city_gdf.to_crs(epsg=3857)
-
-# Load region polygons from MAP.json, stripping unsupported list fields to avoid OGR warnings
-geo_path = "MAP.json"
-with open(geo_path, 'r') as _f:
-    _geojson_raw = json.load(_f)
-for _feature in _geojson_raw.get('features', []):
-    _props = _feature.get('properties', {})
-    if 'regionRoles' in _props:
-        _props.pop('regionRoles', None)
-gdf = gpd.GeoDataFrame.from_features(_geojson_raw.get('features', []), crs="EPSG:4326")
-gdf.set_index("i", inplace=True)
-gdf = gdf.to_crs(epsg=3857)
-gdf["centroid"] = gdf.geometry.centroid
-
-# Helper: check if two regions are adjacent (share a boundary or point) or the same
-def is_adjacent_or_same(origin, destination, tolerance_meters=1.0):
-    if origin == destination:
-        return True
-    # Ensure both regions exist
-    if origin not in gdf.index or destination not in gdf.index:
-        return False
-    geom_origin = gdf.loc[origin].geometry
-    geom_destination = gdf.loc[destination].geometry
-    if geom_origin is None or geom_destination is None:
-        return False
-    # Clean geometries to avoid topology errors
-    geom_origin_clean = geom_origin.buffer(0)
-    geom_destination_clean = geom_destination.buffer(0)
-    # Primary: exact topological adjacency (shared edge or corner, interiors do not overlap)
-    if geom_origin_clean.touches(geom_destination_clean):
-        return True
-    # Allow tiny gaps along borders due to precision issues, but do not treat overlapping as touching
-    try:
-        if (
-            not geom_origin_clean.intersects(geom_destination_clean)
-            and geom_origin_clean.boundary.distance(geom_destination_clean.boundary) <= float(tolerance_meters)
-        ):
-            return True
-    except Exception:
-        pass
-    return False
+from matplotlib.collections import LineCollection
+from SharedOD import open_shared
+from HourIndex import HourIndex
+from Overlays import OverlayLayers
+from Basemap import BasemapLoader, box_outlines, outline_collection, total_bounds
+from Bundling import BundleCache
+from Instrument import phase, timed_frame
+from Scheduler import RenderScheduler
 
 
+# Load city boundary as a polygon
+with phase('geometry'):
+    city_gdf = gpd.read_file('city_boundary.geojson')
+    city_gdf = city_gdf.to_crs(epsg=3857)
 
 NUM_REGIONS = 598
 NUM_TOP = 30
@@ -96,38 +28,14 @@ NUM_TOP = 30
 day_types = ['W', 'SAT', 'SUN', 'ALL']
 day_types2 = ['W', 'SAT', 'SUN']
 
-# Store results: {day: {hour: (top_origins, top_destinations)}}, and counts
-top_per_file = {day: {} for day in day_types}
-
-# Initialize ALL as a dict to accumulate totals {hour: (top_origins, top_destinations)}
-all_top = {hour: {} for hour in range(24)}
-
-for day in day_types2:
-    for hour in range(24):
-        filename = f"{day}{hour}.csv"
-        counts = {}
-        with open(filename, 'r') as f:
-            reader = csv.reader(f)
-            for row in reader:
-                try:
-                    origin = int(row[0].replace('Region ', ''))
-                    dest = int(row[1].replace('Region ', ''))
-                    if is_adjacent_or_same(origin, dest):
-                        continue
-                    count = int(float(row[2]))
-
-                    counts[(origin, dest)] = count
-                    if (day == 'W'):
-                        count = count / 5
-                    all_top[hour][(origin, dest)] = all_top[hour].get((origin, dest), 0) + count
-                except Exception as e:
-                    continue
-        # Store as list of (region, count) tuples, sorted by count
-        top_per_file[day][hour] = heapq.nlargest(NUM_TOP, counts.items(), key=lambda x: x[1])
-
-# At the end, keep only the top 50 in ALL
-for hour in range(24):
-    top_per_file['ALL'][hour] = heapq.nlargest(NUM_TOP, all_top[hour].items(), key=lambda x: x[1])
+# Attach to the shared OD data; weekday trips are averaged per day in the ALL rollup
+od = open_shared(weekday_weight=1 / 5)
+hour_index = HourIndex(od)
+
+# Region cells and centres in EPSG:3857 come from the shared export, so no
+# process has to load and project MAP.json
+cell_bounds = od.bounds_3857
+centroids = od.centroids_3857
 
 # State for current day type
 current_day = ['W']  # Use list for mutability in nested functions
@@ -153,147 +61,146 @@ brt_button = Button(brt_button_ax, 'Toggle\nBRT Stations')
 poi_button_ax = plt.axes([0.745, 0.10, 0.075, 0.06])
 poi_button = Button(poi_button_ax, 'Toggle\nLandmarks')
 
-# Worcester landmarks data
-worcester_landmarks = {
-    'schools': [
-        {'name': 'Worcester Polytechnic Institute (WPI)', 'lat': 42.2746, 'lon': -71.8063, 'type': 'university'},
-        {'name': 'Clark University', 'lat': 42.2507, 'lon': -71.8229, 'type': 'university'},
-        {'name': 'College of the Holy Cross', 'lat': 42.3378, 'lon': -71.8064, 'type': 'university'},
-        {'name': 'UMass Medical School', 'lat': 42.2733, 'lon': -71.7622, 'type': 'university'},
-        {'name': 'Worcester State University', 'lat': 42.2669, 'lon': -71.8644, 'type': 'university'},
-        {'name': 'Assumption University', 'lat': 42.2584, 'lon': -71.8483, 'type': 'university'},
-        {'name': 'Quinsigamond Community College', 'lat': 42.2583, 'lon': -71.8230, 'type': 'college'},
-        {'name': 'Worcester Academy', 'lat': 42.2625, 'lon': -71.8028, 'type': 'high_school'},
-        {'name': 'Bancroft School', 'lat': 42.2792, 'lon': -71.8222, 'type': 'high_school'},
-        {'name': 'Worcester Technical High School', 'lat': 42.2750, 'lon': -71.8400, 'type': 'high_school'},
-    ],
-    
-    'employment': [
-        {'name': 'UMass Memorial Medical Center', 'lat': 42.2733, 'lon': -71.7622, 'type': 'hospital'},
-        {'name': 'Saint Vincent Hospital', 'lat': 42.2681, 'lon': -71.7975, 'type': 'hospital'},
-        {'name': 'The Hanover Insurance Group', 'lat': 42.2625, 'lon': -71.8028, 'type': 'corporate'},
-        {'name': 'Polar Beverages', 'lat': 42.2750, 'lon': -71.8300, 'type': 'corporate'},
-        {'name': 'Fallon Health', 'lat': 42.2650, 'lon': -71.8100, 'type': 'corporate'},
-        {'name': 'Reliant Medical Group', 'lat': 42.2700, 'lon': -71.8200, 'type': 'medical'},
-        {'name': 'Worcester Recovery Center', 'lat': 42.2600, 'lon': -71.8000, 'type': 'hospital'},
-        {'name': 'Allegro MicroSystems', 'lat': 42.2800, 'lon': -71.8100, 'type': 'corporate'},
-        {'name': 'Saint-Gobain', 'lat': 42.2900, 'lon': -71.8200, 'type': 'corporate'},
-        {'name': 'Family Health Center', 'lat': 42.2550, 'lon': -71.8150, 'type': 'medical'},
-    ],
-    
-    'commercial': [
-        {'name': 'CitySquare/Mercantile Center', 'lat': 42.2625, 'lon': -71.8028, 'type': 'shopping'},
-        {'name': 'Downtown Worcester', 'lat': 42.2626, 'lon': -71.8023, 'type': 'shopping'},
-        {'name': 'Worcester Public Market', 'lat': 42.2600, 'lon': -71.8050, 'type': 'shopping'},
-        #{'name': 'The Shops at Blackstone Valley', 'lat': 42.1333, 'lon': -71.6167, 'type': 'shopping'},
-        {'name': 'Greendale Mall Area', 'lat': 42.2333, 'lon': -71.8667, 'type': 'shopping'},
-        {'name': 'Midtown Mall', 'lat': 42.2620, 'lon': -71.8020, 'type': 'shopping'},
-        {'name': 'Lincoln Plaza', 'lat': 42.2700, 'lon': -71.8300, 'type': 'shopping'},
-        {'name': 'Park Avenue Shopping', 'lat': 42.2800, 'lon': -71.8400, 'type': 'shopping'},
-    ]
-}
-
-# Define color and marker mapping for different landmark types
-landmark_style_map = {
-    'university': {'color': 'purple', 'marker': 'U'},
-    'college': {'color': 'purple', 'marker': 'C'},
-    'high_school': {'color': 'blue', 'marker': 'H'},
-    'hospital': {'color': 'red', 'marker': 'H'},
-    'corporate': {'color': 'darkgreen', 'marker': 'C'},
-    'medical': {'color': 'pink', 'marker': 'M'},
-    'shopping': {'color': 'orange', 'marker': 'S'}
-}
-
-# Flatten landmarks into a single list
-landmark_data = []
-for category, landmarks in worcester_landmarks.items():
-    for landmark in landmarks:
-        landmark_type = landmark['type']
-        if landmark_type in landmark_style_map:
-            landmark_data.append({
-                'name': landmark['name'],
-                'lat': landmark['lat'],
-                'lon': landmark['lon'],
-                'type': landmark_type,
-                'category': category,
-                'color': landmark_style_map[landmark_type]['color'],
-                'marker': landmark_style_map[landmark_type]['marker']
-            })
-
-# Transform landmark coordinates to map projection
-landmark_xy = [transformer.transform(landmark['lon'], landmark['lat']) for landmark in landmark_data]
-
-# State for landmark overlay
-overlay_landmarks = [False]
+# BRT stations and landmarks, built once per axes and toggled by visibility
+overlays = OverlayLayers([ax])
+
+# Add a toggle button for edge bundling (also 'b'); bundles are cached per (day, hour, window, K)
+bundle_button_ax = plt.axes([0.895, 0.10, 0.075, 0.06])
+bundle_button = Button(bundle_button_ax, 'Toggle\nBundling')
+bundle_mode = [False]
+bundles = BundleCache()
+
+# Progressive rendering: the first frame is coarse (outlines and routes, no
+# basemap, labels or overlays) so the window appears at once; the refined frame
+# follows as soon as the window is up, and again when the basemap has been fetched
+full_detail = [False]
+basemap = BasemapLoader(fig.canvas, total_bounds(cell_bounds),
+                        on_ready=lambda: scheduler.request((current_day[0], int(slider.val)), force=True))
+
+# Region and city outlines, built once and re-added after every cla()
+region_outlines = box_outlines(cell_bounds, colors='lightgray', linewidths=0.4, zorder=1)
+city_outlines = outline_collection(city_gdf.geometry, colors='blue', linewidths=2, zorder=3)
+
+def draw_outlines(ax):
+    ax.add_collection(region_outlines)
+    ax.add_collection(city_outlines, autolim=False)
+    ax.set_aspect('equal')
+
+# Rolling window over the hour axis (1h, 2h or 3h), answered from hour prefix sums; also cycled with 'w'
+WINDOW_WIDTHS = [1, 2, 3]
+window_hours = [1]
+window_button_ax = plt.axes([0.745, 0.165, 0.075, 0.045])
+window_button = Button(window_button_ax, 'Window\n1h')
+
+# Top-K size, typed into the K box; the shared data stores full rankings, so a
+# new K only slices them
+num_top = [NUM_TOP]
+k_box_ax = plt.axes([0.845, 0.165, 0.05, 0.045])
+k_box = TextBox(k_box_ax, 'K ', initial=str(NUM_TOP))
 
 # Custom colormap from red to green, with more intermediate steps for better color variation
 red_green_cmap = LinearSegmentedColormap.from_list('RedGreen', ['red', 'darkorange', 'limegreen', 'green'], N=256)
 
  
+def hours_text(hour):
+    if window_hours[0] == 1:
+        return f"Hour {hour:02d}:00"
+    return f"Hours {hour:02d}:00-{(hour + window_hours[0]) % 24:02d}:00"
+
+# Top routes for the current window and K; only OD pairs whose regions are neither
+# the same nor neighbouring grid cells. Single hours slice the stored rankings.
+def top_routes(day, hour):
+    if window_hours[0] == 1:
+        return od.top_pairs(day, hour, num_top[0], non_adjacent=True)
+    return hour_index.top_pairs(day, hour, window_hours[0], num_top[0], non_adjacent=True)
+
 
 # Plot function
+@timed_frame()
 def plot_highlight(hour):
-    fig.suptitle(f"Top {NUM_TOP} OD Routes for {pretty_day[current_day[0]]}, Hour {hour:02d}:00", fontsize=18, y=0.97)
+    k = num_top[0]
+    fig.suptitle(f"Top {num_top[0]} OD Routes for {pretty_day[current_day[0]]}, {hours_text(hour)}", fontsize=18, y=0.97)
     ax.cla()
-    gdf.plot(ax=ax, facecolor="none", edgecolor="lightgray", linewidth=0.4)
-    top_od = top_per_file[current_day[0]][hour]
+    draw_outlines(ax)
+    top_od = top_routes(current_day[0], hour)
     cmap = red_green_cmap
-    for i, ((origin, destination), trips) in enumerate(top_od):
-        if origin not in gdf.index or destination not in gdf.index:
-            continue
-        p1 = gdf.loc[origin].centroid
-        p2 = gdf.loc[destination].centroid
-        linewidth = 1.5 + (trips / top_od[0][1]) * 3 if top_od else 2
-        color = cmap(1 - (i / (NUM_TOP-1)))
-        arrow = FancyArrowPatch(
-            (p1.x, p1.y), (p2.x, p2.y),
-            arrowstyle='->',
-            color=color,
-            linewidth=8 * ((1 - ((i + 1) / NUM_TOP))),
-            alpha=0.85,
-            mutation_scale=10 + linewidth * 2,
-            zorder=4
-        )
-        ax.add_patch(arrow)
-    # Overlay city boundary in blue
-    city_gdf.boundary.plot(ax=ax, color='blue', linewidth=2, zorder=3)
-    ctx.add_basemap(ax, source=ctx.providers.CartoDB.Voyager)
+    if bundle_mode[0]:
+        # All flows as bundled polylines in one LineCollection, destinations marked with dots
+        shown = [(i, (od.grid.index_of(origin), od.grid.index_of(destination)), trips)
+                 for i, ((origin, destination), trips) in enumerate(top_od)]
+        shown = [(i, (o, d), trips) for i, (o, d), trips in shown if o >= 0 and d >= 0]
+        if shown:
+            starts = centroids[[o for _, (o, d), _ in shown]]
+            ends = centroids[[d for _, (o, d), _ in shown]]
+            trips = np.array([t for _, _, t in shown], dtype=np.float64)
+            paths = bundles.get((current_day[0], hour, window_hours[0], k), starts, ends, trips)
+            ranks = [i for i, _, _ in shown]
+            colors = [cmap(1 - (i / max(k - 1, 1))) for i in ranks]
+            widths = [max(8 * (1 - ((i + 1) / k)), 0.5) for i in ranks]
+            ax.add_collection(LineCollection(paths, colors=colors, linewidths=widths, alpha=0.7,
+                                             capstyle='round', zorder=4))
+            ax.scatter(ends[:, 0], ends[:, 1], c=colors, s=25, edgecolors='black', linewidths=0.5, zorder=5)
+    else:
+        for i, ((origin, destination), trips) in enumerate(top_od):
+            o, d = od.grid.index_of(origin), od.grid.index_of(destination)
+            if o < 0 or d < 0:
+                continue
+            linewidth = 1.5 + (trips / top_od[0][1]) * 3 if top_od else 2
+            color = cmap(1 - (i / max(k - 1, 1)))
+            arrow = FancyArrowPatch(
+                tuple(centroids[o]), tuple(centroids[d]),
+                arrowstyle='->',
+                color=color,
+                linewidth=8 * ((1 - ((i + 1) / k))),
+                alpha=0.85,
+                mutation_scale=10 + linewidth * 2,
+                zorder=4
+            )
+            ax.add_patch(arrow)
+    # Basemap from the background fetch, once it is ready
+    with phase('basemap'):
+        basemap.draw(ax)
     ax.set_title("Top OD Arrows", fontsize=15, pad=18)
     ax.set_axis_off()
-    if len(top_od) >= NUM_TOP:
-        trip1 = top_od[0][1]
-        trip50 = top_od[NUM_TOP-1][1]
-        ax.text(0.01, 0.99, f"#1: {trip1} trips\n#{NUM_TOP}: {trip50} trips", transform=ax.transAxes,
-                fontsize=14, color="black", va="top", ha="left",
-                bbox=dict(facecolor='white', alpha=0.7, edgecolor='none'))
-    elif len(top_od) > 0:
-        trip1 = top_od[0][1]
-        ax.text(0.01, 0.99, f"#1: {trip1} trips", transform=ax.transAxes,
-                fontsize=14, color="black", va="top", ha="left",
-                bbox=dict(facecolor='white', alpha=0.7, edgecolor='none'))
-    # Overlay BRT stations if toggled
-    if overlay_brt[0]:
-        xs, ys = zip(*brt_xy)
-        ax.scatter(xs, ys, c='deepskyblue', s=80, marker='o', edgecolor='black', zorder=10, label='BRT Station')
-    # Overlay landmarks if toggled
-    if overlay_landmarks[0]:
-        for i, (landmark, (x, y)) in enumerate(zip(landmark_data, landmark_xy)):
-            ax.scatter(x, y, c=landmark['color'], s=100, marker='o', edgecolor='black', zorder=11)
-            ax.text(x, y, landmark['name'], fontsize=3.5, color='white', ha='center', va='center', 
-                   weight='bold', zorder=12, bbox=dict(facecolor='black', alpha=0.7, edgecolor='none', pad=1))
+    # Labels and overlays are left out of the coarse first frame
+    if full_detail[0]:
+        if len(top_od) >= k:
+            trip1 = top_od[0][1]
+            trip50 = top_od[k-1][1]
+            ax.text(0.01, 0.99, f"#1: {trip1} trips\n#{k}: {trip50} trips", transform=ax.transAxes,
+                    fontsize=14, color="black", va="top", ha="left",
+                    bbox=dict(facecolor='white', alpha=0.7, edgecolor='none'))
+        elif len(top_od) > 0:
+            trip1 = top_od[0][1]
+            ax.text(0.01, 0.99, f"#1: {trip1} trips", transform=ax.transAxes,
+                    fontsize=14, color="black", va="top", ha="left",
+                    bbox=dict(facecolor='white', alpha=0.7, edgecolor='none'))
+        # Overlay BRT stations and landmarks (shown only if toggled on)
+        overlays.attach(ax)
     plt.draw()
 
-plot_highlight(0)
+# Coalesce slider, button and keyboard events; only the latest (day, hour) is rendered
+scheduler = RenderScheduler(fig.canvas, lambda day, hour: plot_highlight(hour))
+scheduler.render_now((current_day[0], 0))
+
+# Refine the coarse first frame once the event loop is running
+def refine():
+    full_detail[0] = True
+    scheduler.request((current_day[0], int(slider.val)), force=True)
+refine_timer = fig.canvas.new_timer(interval=1)
+refine_timer.single_shot = True
+refine_timer.add_callback(refine)
+refine_timer.start()
 
 # Slider update
 def update(val):
-    plot_highlight(int(slider.val))
+    scheduler.request((current_day[0], int(slider.val)))
 slider.on_changed(update)
 
 # Function to switch day type
 def switch_day(day, button):
     current_day[0] = day
-    plot_highlight(int(slider.val))
+    scheduler.request((current_day[0], int(slider.val)))
 
 # Button callbacks
 def make_button_callback(day, button):
@@ -309,22 +216,53 @@ switch_day('W', buttons[0])
 
 # BRT toggle button callback
 def toggle_brt(event):
-    overlay_brt[0] = not overlay_brt[0]
-    plot_highlight(int(slider.val))
+    overlays.toggle('brt')
 brt_button.on_clicked(toggle_brt)
 
 # POI toggle button callback
 def toggle_poi(event):
-    overlay_landmarks[0] = not overlay_landmarks[0]
-    plot_highlight(int(slider.val))
+    overlays.toggle('landmarks')
 poi_button.on_clicked(toggle_poi)
 
+# Window toggle button callback
+def toggle_window(event=None):
+    window_hours[0] = WINDOW_WIDTHS[(WINDOW_WIDTHS.index(window_hours[0]) + 1) % len(WINDOW_WIDTHS)]
+    window_button.label.set_text(f"Window\n{window_hours[0]}h")
+    scheduler.request((current_day[0], int(slider.val)), force=True)
+window_button.on_clicked(toggle_window)
+
+# K box callback: accept a positive whole number, otherwise restore the current K
+def set_top(text):
+    try:
+        k = int(text)
+    except ValueError:
+        k = 0
+    if k < 1:
+        k_box.set_val(str(num_top[0]))
+        return
+    num_top[0] = k
+    scheduler.request((current_day[0], int(slider.val)), force=True)
+k_box.on_submit(set_top)
+
+# Bundling toggle button callback
+def toggle_bundling(event=None):
+    bundle_mode[0] = not bundle_mode[0]
+    scheduler.request((current_day[0], int(slider.val)), force=True)
+bundle_button.on_clicked(toggle_bundling)
+
 # Keyboard event handler for arrow keys
 def on_key(event):
+    # Keys typed into the K box are not shortcuts
+    if k_box.capturekeystrokes:
+        return
     if event.key == 'left':
         slider.set_val((slider.val - 1) % 24)
     elif event.key == 'right':
         slider.set_val((slider.val + 1) % 24)
+    elif event.key == 'b':
+        toggle_bundling()
+    elif event.key == 'w':
+        toggle_window()
     elif event.key == 'tab':
         if (current_day[0] == 'W'):
             switch_day('SAT', buttons[1])
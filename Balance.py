@@ -0,0 +1,202 @@
+# Balancing of the hourly OD slices to target origin and destination totals
+# by iterative proportional fitting (Furness). Each slice X is rescaled to
+#     a[i] * X[i, j] * b[j]
+# with row factors a and column factors b updated in turn until the row sums
+# match the origin targets and the column sums the destination targets.
+#
+# All 72 base slices are fitted together: their non-zero entries are stacked
+# into one array with a slice number, so each half-step is one bincount over
+# every slice instead of a Python loop per slice. Iteration stops when every
+# slice is within the tolerance; the iteration at which each slice got there,
+# and the worst slice error after every iteration, are kept in a FitReport.
+#
+# By default the targets are each file's own marginals per day (weekday files
+# divided by 5), so every slice ends up on the same trips-per-day scale. Any
+# other targets can be given as a CSV with day, hour, region, origin and
+# destination columns. Regions with a target but no trips in a slice cannot be
+# fitted; they are reported and left out of the error.
+#
+# Usage: python Balance.py [--targets targets.csv] [--iters 100] [--tol 1e-6]
+#        [--out od_balanced.npz]
+
+import argparse
+import numpy as np
+import scipy.sparse as sp
+from Grid import load_grid
+from ODData import day_types2, DAYS_PER_SLICE, HOURS, SparseOD
+
+BALANCED_PATH = 'od_balanced.npz'
+MAX_ITERS = 100
+TOLERANCE = 1e-6
+
+slice_keys = [(day, hour) for day in day_types2 for hour in range(HOURS)]
+
+
+# Non-zero entries of every base slice as (slice number, origin, destination, trips)
+def stack_slices(od):
+    parts = [sp.coo_matrix(od.matrix(day, hour)) for day, hour in slice_keys]
+    slices = np.concatenate([np.full(m.nnz, t, dtype=np.int64) for t, m in enumerate(parts)])
+    rows = np.concatenate([m.row for m in parts]).astype(np.int64)
+    cols = np.concatenate([m.col for m in parts]).astype(np.int64)
+    values = np.concatenate([m.data for m in parts]).astype(np.float64)
+    return slices, rows, cols, values
+
+
+# Each slice's own marginals on a per-day scale, shape (72, n) each
+def daily_targets(od):
+    days = np.array([DAYS_PER_SLICE[day] for day, hour in slice_keys], dtype=np.float64)[:, None]
+    origins = np.array([od.origin_totals(day, hour) for day, hour in slice_keys]) / days
+    destinations = np.array([od.destination_totals(day, hour) for day, hour in slice_keys]) / days
+    return origins, destinations
+
+
+def read_targets(path, grid):
+    import pandas as pd
+    table = pd.read_csv(path)
+    day_index = {day: d for d, day in enumerate(day_types2)}
+    day = table['day'].map(day_index).to_numpy(dtype=np.float64)
+    hour = table['hour'].to_numpy(dtype=np.float64)
+    label = table['region'].to_numpy(dtype=np.float64)
+    # Check hours and region numbers before indexing with them (NaN fails every test)
+    bad = (np.isnan(day) | ~((hour >= 0) & (hour < HOURS) & (hour == np.floor(hour)))
+           | ~((label >= 0) & (label < len(grid.label_to_index)) & (label == np.floor(label))))
+    region = np.full(len(table), -1, dtype=np.int64)
+    region[~bad] = grid.label_to_index[label[~bad].astype(np.int64)]
+    bad |= region < 0
+    if bad.any():
+        raise ValueError(f"{path}: {int(bad.sum())} rows with an unknown day type, hour or region "
+                         f"(first on line {int(np.argmax(bad)) + 2})")
+    t = day.astype(np.int64) * HOURS + hour.astype(np.int64)
+    origins = np.zeros((len(slice_keys), grid.n_regions))
+    destinations = np.zeros((len(slice_keys), grid.n_regions))
+    np.add.at(origins, (t, region), table['origin'].to_numpy(dtype=np.float64))
+    np.add.at(destinations, (t, region), table['destination'].to_numpy(dtype=np.float64))
+    return origins, destinations
+
+
+class FitReport:
+    def __init__(self, n_slices):
+        self.history = []                                       # max slice error after each iteration
+        self.converged_at = np.full(n_slices, -1, dtype=np.int64)  # iteration each slice converged, -1 if not
+        self.errors = np.full(n_slices, np.nan)                 # final relative row error per slice
+        self.unreachable = np.zeros(n_slices)                   # target trips on rows/columns without trips
+        self.target_ratio = np.ones(n_slices)                   # destination / origin target total before fitting
+
+    @property
+    def iterations(self):
+        return len(self.history)
+
+    @property
+    def converged(self):
+        return bool((self.converged_at >= 0).all())
+
+    def summary(self):
+        lines = [f"{self.iterations} iterations, max error {self.history[-1]:.2e}" if self.history else "0 iterations"]
+        lines.append(f"{int((self.converged_at >= 0).sum())} of {len(self.converged_at)} slices converged")
+        for t in np.flatnonzero(self.converged_at < 0):
+            day, hour = slice_keys[t]
+            lines.append(f"  {day}{hour} not converged, error {self.errors[t]:.2e}")
+        for t in np.flatnonzero(self.unreachable > 0):
+            day, hour = slice_keys[t]
+            lines.append(f"  {day}{hour}: {self.unreachable[t]:.1f} target trips on regions without trips")
+        for t in np.flatnonzero(np.abs(self.target_ratio - 1) > 1e-9):
+            day, hour = slice_keys[t]
+            lines.append(f"  {day}{hour}: destination targets rescaled by {1 / self.target_ratio[t]:.4f} "
+                         f"to match the origin total")
+        return '\n'.join(lines)
+
+
+# Batched Furness over stacked entries; returns (balanced values, FitReport)
+def furness(slices, rows, cols, values, origin_targets, destination_targets, iters=MAX_ITERS, tol=TOLERANCE):
+    n_slices, n = origin_targets.shape
+    size = n_slices * n
+    row_keys = slices * n + rows
+    col_keys = slices * n + cols
+    report = FitReport(n_slices)
+
+    # Targets on rows or columns without any trips can never be met
+    has_row = np.bincount(row_keys, minlength=size).reshape(n_slices, n) > 0
+    has_col = np.bincount(col_keys, minlength=size).reshape(n_slices, n) > 0
+    report.unreachable = (np.where(has_row, 0.0, origin_targets).sum(axis=1)
+                          + np.where(has_col, 0.0, destination_targets).sum(axis=1))
+    origin_targets = np.where(has_row, origin_targets, 0.0)
+    destination_targets = np.where(has_col, destination_targets, 0.0)
+    row_total = origin_targets.sum(axis=1)
+    col_total = destination_targets.sum(axis=1)
+    report.target_ratio = np.divide(col_total, row_total, out=np.ones(n_slices), where=row_total > 0)
+    destination_targets = destination_targets / report.target_ratio[:, None]
+    row_target = origin_targets.ravel()
+    col_target = destination_targets.ravel()
+    scale = np.maximum(row_total, 1e-12)
+
+    a = np.ones(size)
+    b = np.ones(size)
+    for iteration in range(iters):
+        sums = np.bincount(row_keys, weights=values * b[col_keys], minlength=size)
+        a = np.divide(row_target, sums, out=np.zeros(size), where=sums > 0)
+        sums = np.bincount(col_keys, weights=values * a[row_keys], minlength=size)
+        b = np.divide(col_target, sums, out=np.zeros(size), where=sums > 0)
+
+        # Columns are exact after the column step, so the row sums measure the error
+        fitted = np.bincount(row_keys, weights=values * a[row_keys] * b[col_keys], minlength=size)
+        errors = np.abs(fitted - row_target).reshape(n_slices, n).sum(axis=1) / scale
+        report.errors = errors
+        report.history.append(float(errors.max()))
+        report.converged_at[(errors < tol) & (report.converged_at < 0)] = iteration + 1
+        if (errors < tol).all():
+            break
+    return values * a[row_keys] * b[col_keys], report
+
+
+# Balanced copy of a store's base slices as a SparseOD (trips per day, so ALL
+# is the plain sum of W, SAT and SUN) together with the FitReport
+def balance(od, origin_targets=None, destination_targets=None, iters=MAX_ITERS, tol=TOLERANCE):
+    if origin_targets is None or destination_targets is None:
+        origin_targets, destination_targets = daily_targets(od)
+    slices, rows, cols, values = stack_slices(od)
+    fitted, report = furness(slices, rows, cols, values, origin_targets, destination_targets, iters, tol)
+    return balanced_store(od.grid, slices, rows, cols, fitted), report
+
+
+def balanced_store(grid, slices, rows, cols, values):
+    n = grid.n_regions
+    matrices = {}
+    for t, key in enumerate(slice_keys):
+        keep = slices == t
+        matrices[key] = sp.csr_matrix((values[keep], (rows[keep], cols[keep])), shape=(n, n))
+    return SparseOD(grid, matrices, weekday_weight=1.0)
+
+
+def save_balanced(od, path=BALANCED_PATH):
+    slices, rows, cols, values = stack_slices(od)
+    np.savez(path, slices=slices, rows=rows, cols=cols, values=values)
+
+
+def load_balanced(path=BALANCED_PATH, geo_path="MAP.json"):
+    with np.load(path) as data:
+        return balanced_store(load_grid(geo_path), data['slices'], data['rows'], data['cols'], data['values'])
+
+
+if __name__ == '__main__':
+    from SharedOD import open_shared
+
+    parser = argparse.ArgumentParser(description="Fit every hourly OD slice to origin/destination totals (IPF).")
+    parser.add_argument('--targets', default=None, help="CSV with day, hour, region, origin, destination")
+    parser.add_argument('--iters', type=int, default=MAX_ITERS)
+    parser.add_argument('--tol', type=float, default=TOLERANCE)
+    parser.add_argument('--out', default=BALANCED_PATH)
+    args = parser.parse_args()
+
+    od = open_shared()
+    if args.targets:
+        origin_targets, destination_targets = read_targets(args.targets, od.grid)
+    else:
+        origin_targets, destination_targets = daily_targets(od)
+    balanced, report = balance(od, origin_targets, destination_targets, args.iters, args.tol)
+    print(report.summary())
+    save_balanced(balanced, args.out)
+
+    print("Trips per day by slice after balancing:")
+    for day in day_types2:
+        print(f"  {day:>3}: " + ' '.join(f"{balanced.trip_total(day, hour):.0f}" for hour in range(HOURS)))
+    print(f"Wrote {args.out}")
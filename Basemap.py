@@ -0,0 +1,132 @@
+# Progressive map rendering helpers for the viewers.
+# BasemapLoader fetches one basemap image for the whole map extent in a
+# background thread (the viewers' extent never changes, so every frame and
+# panel can reuse it) and keeps a copy under od_cache/, so later runs load it
+# from disk instead of the network. Until the image is ready, frames are drawn
+# without it; when it arrives, on_ready() is called on the GUI thread through
+# a canvas timer, since matplotlib must not be touched from the fetch thread.
+#
+# outline_collection() turns polygon outlines into one LineCollection that a
+# viewer builds once per axes and re-adds after cla(), instead of calling
+# GeoSeries.plot() on every frame.
+
+import hashlib
+import os
+import sys
+import threading
+import time
+import numpy as np
+import contextily as ctx
+from matplotlib.collections import LineCollection, PolyCollection
+import Instrument
+from ODCache import CACHE_DIR
+
+POLL_MS = 100
+
+
+def _rings(geometry):
+    if geometry.geom_type == 'Polygon':
+        return [np.asarray(geometry.exterior.coords)] + [np.asarray(r.coords) for r in geometry.interiors]
+    if geometry.geom_type in ('MultiPolygon', 'GeometryCollection'):
+        return [ring for part in geometry.geoms for ring in _rings(part)]
+    if geometry.geom_type in ('LineString', 'LinearRing'):
+        return [np.asarray(geometry.coords)]
+    return []
+
+
+def outline_collection(geometries, **style):
+    rings = [ring[:, :2] for geometry in geometries if geometry is not None for ring in _rings(geometry)]
+    return LineCollection(rings, **style)
+
+
+# Closed rings of axis-aligned boxes given as (minx, miny, maxx, maxy) rows,
+# e.g. the grid cells of SharedOD.bounds_3857
+def box_rings(bounds):
+    minx, miny, maxx, maxy = np.asarray(bounds, dtype=np.float64).T
+    corners = [(minx, miny), (maxx, miny), (maxx, maxy), (minx, maxy), (minx, miny)]
+    return np.stack([np.column_stack(corner) for corner in corners], axis=1)
+
+
+def box_outlines(bounds, **style):
+    return LineCollection(box_rings(bounds), **style)
+
+
+def box_patches(bounds, **style):
+    return PolyCollection(box_rings(bounds), **style)
+
+
+# (minx, miny, maxx, maxy) around all boxes
+def total_bounds(bounds):
+    bounds = np.asarray(bounds, dtype=np.float64)
+    return (*bounds[:, :2].min(axis=0), *bounds[:, 2:].max(axis=0))
+
+
+class BasemapLoader:
+    def __init__(self, canvas, bounds, source=ctx.providers.CartoDB.Voyager, on_ready=None,
+                 pad=0.05, cache_dir=CACHE_DIR):
+        minx, miny, maxx, maxy = bounds
+        dx, dy = (maxx - minx) * pad, (maxy - miny) * pad
+        self.bounds = (minx - dx, miny - dy, maxx + dx, maxy + dy)
+        self.source = source
+        self.on_ready = on_ready
+        self.image = None
+        self.extent = None
+        self.error = None
+        self.fetch_seconds = None
+        self.from_disk = False
+
+        state = repr((source.get('url', source.get('name')), tuple(round(b, 1) for b in self.bounds)))
+        key = hashlib.sha1(state.encode()).hexdigest()[:16]
+        self.path = os.path.join(cache_dir, f"basemap_{key}.npz")
+        Instrument.add_source('basemap', self.stats)
+
+        if os.path.exists(self.path):
+            with np.load(self.path) as data:
+                self.image, self.extent = data['image'], tuple(data['extent'])
+            self.from_disk = True
+            return
+        self.thread = threading.Thread(target=self._fetch, daemon=True)
+        self.thread.start()
+        self.timer = canvas.new_timer(interval=POLL_MS)
+        self.timer.add_callback(self._poll)
+        self.timer.start()
+
+    @property
+    def ready(self):
+        return self.image is not None
+
+    def _fetch(self):
+        start = time.perf_counter()
+        try:
+            image, extent = ctx.bounds2img(*self.bounds, source=self.source)
+            os.makedirs(os.path.dirname(self.path) or '.', exist_ok=True)
+            tmp = f"{self.path}.tmp{os.getpid()}.npz"
+            np.savez(tmp, image=image, extent=np.array(extent))
+            os.replace(tmp, self.path)
+            self.image, self.extent = image, tuple(extent)
+        except Exception as e:
+            self.error = e
+        self.fetch_seconds = time.perf_counter() - start
+
+    def _poll(self):
+        if self.thread.is_alive():
+            return
+        self.timer.stop()
+        if self.error is not None:
+            print(f"Basemap unavailable, drawing without it: {self.error}", file=sys.stderr)
+        elif self.on_ready is not None:
+            self.on_ready()
+
+    # Draw the basemap under everything else without changing the axes limits
+    def draw(self, ax):
+        if self.image is None:
+            return
+        xlim, ylim = ax.get_xlim(), ax.get_ylim()
+        left, right, bottom, top = self.extent
+        ax.imshow(self.image, extent=(left, right, bottom, top), interpolation='bilinear', zorder=0)
+        ax.set_xlim(xlim)
+        ax.set_ylim(ylim)
+
+    def stats(self):
+        return {'ready': self.ready, 'from_disk': self.from_disk, 'fetch_s': self.fetch_seconds,
+                'error': None if self.error is None else str(self.error)}
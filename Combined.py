@@ -2,50 +2,28 @@
 # and overlays the BRT stations and landmarks.
 # It is used to visualize the most popular regions in the city.
 
-import csv
-import heapq
-import os
-import json
 import matplotlib.pyplot as plt
 import geopandas as gpd
-import contextily as ctx
 import numpy as np
-from matplotlib.widgets import Slider, Button
-from pyproj import Transformer
+from matplotlib.widgets import Slider, Button, TextBox
+from matplotlib.patches import Rectangle
+from SharedOD import open_shared
+from HourIndex import HourIndex
+from Overlays import OverlayLayers
+from Basemap import BasemapLoader, box_outlines, box_patches, outline_collection, total_bounds
+from Raster import draw_heatmap
+from Instrument import phase, timed_frame
+from Scheduler import RenderScheduler
 import warnings
 
 # Suppress OGR field type warnings
 warnings.filterwarnings('ignore', message='.*unsupported OGR type.*')
 
 
-# BRT station coordinates (WGS84)
-brt_stations = [
-    {"id": "brt_1", "lat": 42.314139, "lon": -71.791083},
-    {"id": "brt_2", "lat": 42.301139, "lon": -71.801972},
-    {"id": "brt_3", "lat": 42.276472, "lon": -71.801556},
-    {"id": "brt_4", "lat": 42.271686, "lon": -71.800596},
-    {"id": "brt_5", "lat": 42.264190, "lon": -71.795404},
-    {"id": "brt_6", "lat": 42.255527, "lon": -71.797340},
-    {"id": "brt_7", "lat": 42.241968, "lon": -71.801111},
-    {"id": "brt_8", "lat": 42.232811, "lon": -71.793633},
-    {"id": "brt_9", "lat": 42.268892, "lon": -71.842723},
-    {"id": "brt_10", "lat": 42.262146, "lon": -71.822375},
-    {"id": "brt_11", "lat": 42.248583, "lon": -71.829806},
-    {"id": "brt_12", "lat": 42.265997, "lon": -71.785728},
-    {"id": "brt_13", "lat": 42.276670, "lon": -71.763703}
-]
-brt_ids = [x['id'] for x in brt_stations]
-
-# Transform BRT station coordinates to map projection (EPSG:3857)
-transformer = Transformer.from_crs("epsg:4326", "epsg:3857", always_xy=True)
-brt_xy = [transformer.transform(station['lon'], station['lat']) for station in brt_stations]
-
-# State for BRT overlay
-overlay_brt = [False]
-
 # Load city boundary as a polygon
-city_gdf = gpd.read_file('city_boundary.geojson')
-city_gdf = city_gdf.to_crs(epsg=3857)
+with phase('geometry'):
+    city_gdf = gpd.read_file('city_boundary.geojson')
+    city_gdf = city_gdf.to_crs(epsg=3857)
 
 # Define adjacency in grid
 def is_adjacent_or_same(r1, r2):
@@ -66,69 +44,22 @@ NUM_TOP = 1
 day_types = ['W', 'SAT', 'SUN', 'ALL']
 day_types2 = ['W', 'SAT', 'SUN']
 
-# Store results: {day: {hour: (top_origins, top_destinations)}}, and counts
-top_origins_per_file = {day: {hour: {} for hour in range(24)} for day in day_types}
-top_destinations_per_file = {day: {hour: {} for hour in range(24)} for day in day_types}
-top_combined_per_file = {day: {hour: {} for hour in range(24)} for day in day_types}
-
-# Initialize ALL as a dict to accumulate totals {hour: (top_origins, top_destinations)}
-All_top_origins = {hour: {} for hour in range(24)}
-All_top_destinations = {hour: {} for hour in range(24)}
-All_top_combined = {hour: {} for hour in range(24)}
-
-
-for day in day_types2:
-    for hour in range(24):
-        filename = f"{day}{hour}.csv"
-        origin_counts = {}
-        dest_counts = {}
-        combined_counts = {}
-        with open(filename, 'r') as f:
-            reader = csv.reader(f)
-            for row in reader:
-                try:
-                    origin = int(row[0].replace('Region ', ''))
-                    dest = int(row[1].replace('Region ', ''))
-                    count = int(float(row[2]))
-
-                    origin_counts[origin] = origin_counts.get(origin, 0) + count
-                    dest_counts[dest] = dest_counts.get(dest, 0) + count
-                    combined_counts[origin] = combined_counts.get(origin, 0) + count
-                    combined_counts[dest] = combined_counts.get(dest, 0) + count
-
-                    All_top_origins[hour][origin] = All_top_origins[hour].get(origin, 0) + count
-                    All_top_destinations[hour][dest] = All_top_destinations[hour].get(dest, 0) + count
-                    All_top_combined[hour][origin] = All_top_combined[hour].get(origin, 0) + count
-                    All_top_combined[hour][dest] = All_top_combined[hour].get(dest, 0) + count
-                except Exception as e:
-                    continue
-        # Store as list of (region, count) tuples, sorted by count
-        top_origins = heapq.nlargest(NUM_TOP, origin_counts.items(), key=lambda x: x[1])
-        top_destinations = heapq.nlargest(NUM_TOP, dest_counts.items(), key=lambda x: x[1])
-        top_combined = heapq.nlargest(NUM_TOP, combined_counts.items(), key=lambda x: x[1])
-
-
-        top_origins_per_file[day][hour] = top_origins
-        top_destinations_per_file[day][hour] = top_destinations
-        top_combined_per_file[day][hour] = top_combined
-
-# At the end, keep only the top 50 in ALL
-for hour in range(24):
-    top_origins_per_file['ALL'][hour] = heapq.nlargest(NUM_TOP, All_top_origins[hour].items(), key=lambda x: x[1])
-    top_destinations_per_file['ALL'][hour] = heapq.nlargest(NUM_TOP, All_top_destinations[hour].items(), key=lambda x: x[1])
-    top_combined_per_file['ALL'][hour] = heapq.nlargest(NUM_TOP, All_top_combined[hour].items(), key=lambda x: x[1])
-
-# Load region polygons from MAP.json
-geo_path = "MAP.json"
-gdf = gpd.read_file(geo_path)
-gdf.set_index("i", inplace=True)
-gdf = gdf.to_crs(epsg=3857)
-gdf["centroid"] = gdf.geometry.centroid
+# Attach to the shared OD data (the cache only re-reads new or changed hourly files)
+od = open_shared()
+hour_index = HourIndex(od)
+
+# Region cells and centres in EPSG:3857 come from the shared export, so no
+# process has to load and project MAP.json
+cell_bounds = od.bounds_3857
+centroids = od.centroids_3857
 
 
 # State for current day type
 current_day = ['W']  # Use list for mutability in nested functions
 
+# 's' cycles the heatmap smoothing, so take it off matplotlib's save keys (ctrl+s still saves)
+plt.rcParams['keymap.save'] = [key for key in plt.rcParams['keymap.save'] if key != 's']
+
 # Update to 3 subplots for Origins, Destinations, Combined
 fig, (ax1, ax2, ax3) = plt.subplots(1, 3, figsize=(24, 12))
 plt.subplots_adjust(bottom=0.22, top=0.88)  # Increase top margin to avoid title overlap
@@ -150,109 +81,168 @@ brt_button = Button(brt_button_ax, 'Toggle\nBRT Stations')
 poi_button_ax = plt.axes([0.745, 0.10, 0.075, 0.06])
 poi_button = Button(poi_button_ax, 'Toggle\nLandmarks')
 
-# Worcester landmarks data
-worcester_landmarks = {
-    'schools': [
-        {'name': 'Worcester Polytechnic Institute (WPI)', 'lat': 42.2746, 'lon': -71.8063, 'type': 'university'},
-        {'name': 'Clark University', 'lat': 42.2507, 'lon': -71.8229, 'type': 'university'},
-        {'name': 'College of the Holy Cross', 'lat': 42.3378, 'lon': -71.8064, 'type': 'university'},
-        {'name': 'UMass Medical School', 'lat': 42.2733, 'lon': -71.7622, 'type': 'university'},
-        {'name': 'Worcester State University', 'lat': 42.2669, 'lon': -71.8644, 'type': 'university'},
-        {'name': 'Assumption University', 'lat': 42.2584, 'lon': -71.8483, 'type': 'university'},
-        {'name': 'Quinsigamond Community College', 'lat': 42.2583, 'lon': -71.8230, 'type': 'college'},
-        {'name': 'Worcester Academy', 'lat': 42.2625, 'lon': -71.8028, 'type': 'high_school'},
-        {'name': 'Bancroft School', 'lat': 42.2792, 'lon': -71.8222, 'type': 'high_school'},
-        {'name': 'Worcester Technical High School', 'lat': 42.2750, 'lon': -71.8400, 'type': 'high_school'},
-    ],
-    
-    'employment': [
-        {'name': 'UMass Memorial Medical Center', 'lat': 42.2733, 'lon': -71.7622, 'type': 'hospital'},
-        {'name': 'Saint Vincent Hospital', 'lat': 42.2681, 'lon': -71.7975, 'type': 'hospital'},
-        {'name': 'The Hanover Insurance Group', 'lat': 42.2625, 'lon': -71.8028, 'type': 'corporate'},
-        {'name': 'Polar Beverages', 'lat': 42.2750, 'lon': -71.8300, 'type': 'corporate'},
-        {'name': 'Fallon Health', 'lat': 42.2650, 'lon': -71.8100, 'type': 'corporate'},
-        {'name': 'Reliant Medical Group', 'lat': 42.2700, 'lon': -71.8200, 'type': 'medical'},
-        {'name': 'Worcester Recovery Center', 'lat': 42.2600, 'lon': -71.8000, 'type': 'hospital'},
-        {'name': 'Allegro MicroSystems', 'lat': 42.2800, 'lon': -71.8100, 'type': 'corporate'},
-        {'name': 'Saint-Gobain', 'lat': 42.2900, 'lon': -71.8200, 'type': 'corporate'},
-        {'name': 'Family Health Center', 'lat': 42.2550, 'lon': -71.8150, 'type': 'medical'},
-    ],
-    
-    'commercial': [
-        {'name': 'CitySquare/Mercantile Center', 'lat': 42.2625, 'lon': -71.8028, 'type': 'shopping'},
-        {'name': 'Downtown Worcester', 'lat': 42.2626, 'lon': -71.8023, 'type': 'shopping'},
-        {'name': 'Worcester Public Market', 'lat': 42.2600, 'lon': -71.8050, 'type': 'shopping'},
-        #{'name': 'The Shops at Blackstone Valley', 'lat': 42.1333, 'lon': -71.6167, 'type': 'shopping'},
-        {'name': 'Greendale Mall Area', 'lat': 42.2333, 'lon': -71.8667, 'type': 'shopping'},
-        {'name': 'Midtown Mall', 'lat': 42.2620, 'lon': -71.8020, 'type': 'shopping'},
-        {'name': 'Lincoln Plaza', 'lat': 42.2700, 'lon': -71.8300, 'type': 'shopping'},
-        {'name': 'Park Avenue Shopping', 'lat': 42.2800, 'lon': -71.8400, 'type': 'shopping'},
-    ]
-}
-
-# Define color and marker mapping for different landmark types
-landmark_style_map = {
-    'university': {'color': 'purple', 'marker': 'U'},
-    'college': {'color': 'purple', 'marker': 'C'},
-    'high_school': {'color': 'blue', 'marker': 'H'},
-    'hospital': {'color': 'red', 'marker': 'H'},
-    'corporate': {'color': 'darkgreen', 'marker': 'C'},
-    'medical': {'color': 'pink', 'marker': 'M'},
-    'shopping': {'color': 'orange', 'marker': 'S'}
-}
-
-# Flatten landmarks into a single list
-landmark_data = []
-for category, landmarks in worcester_landmarks.items():
-    for landmark in landmarks:
-        landmark_type = landmark['type']
-        if landmark_type in landmark_style_map:
-            landmark_data.append({
-                'name': landmark['name'],
-                'lat': landmark['lat'],
-                'lon': landmark['lon'],
-                'type': landmark_type,
-                'category': category,
-                'color': landmark_style_map[landmark_type]['color'],
-                'marker': landmark_style_map[landmark_type]['marker']
-            })
-
-# Transform landmark coordinates to map projection
-landmark_xy = [transformer.transform(landmark['lon'], landmark['lat']) for landmark in landmark_data]
-
-# State for landmark overlay
-overlay_landmarks = [False]
-
+# Add a toggle button for the raster heatmap mode
+heatmap_button_ax = plt.axes([0.895, 0.10, 0.075, 0.06])
+heatmap_button = Button(heatmap_button_ax, 'Toggle\nHeatmap')
+
+# BRT stations and landmarks, built once per axes and toggled by visibility
+overlays = OverlayLayers([ax1, ax2, ax3])
+
+# State for raster heatmap mode: on/off, and k-ring smoothing radius (cycled with 's')
+heatmap_mode = [False]
+heatmap_smoothing = [0]
+
+# Rolling window over the hour axis (1h, 2h or 3h), answered from hour prefix sums; also cycled with 'w'
+WINDOW_WIDTHS = [1, 2, 3]
+window_hours = [1]
+window_button_ax = plt.axes([0.745, 0.165, 0.075, 0.045])
+window_button = Button(window_button_ax, 'Window\n1h')
+
+# Top-K size, typed into the K box; the shared data stores full rankings, so a
+# new K only slices them
+num_top = [NUM_TOP]
+k_box_ax = plt.axes([0.845, 0.165, 0.05, 0.045])
+k_box = TextBox(k_box_ax, 'K ', initial=str(NUM_TOP))
+
+# Region picked by clicking a map, found by grid arithmetic (no polygon tests);
+# right-click or Escape clears it. Its top links and 24-hour profile follow the slider.
+NUM_PICK_LINKS = 5
+picked = [None]        # (axes, measure, region index)
+pick_artists = []
+
+# One 24-hour profile chart per panel, created once as figure axes (so cla() keeps
+# them) and only updated on a pick
+def make_profile_axes(ax):
+    box = ax.get_position()
+    profile_ax = fig.add_axes([box.x0 + 0.60 * box.width, box.y0 + 0.80 * box.height,
+                               0.38 * box.width, 0.17 * box.height], zorder=10)
+    bars = profile_ax.bar(range(24), np.zeros(24), color='gray', width=0.8)
+    profile_ax.set_xticks([0, 6, 12, 18, 23])
+    profile_ax.tick_params(labelsize=7)
+    profile_ax.set_visible(False)
+    return profile_ax, bars
+
+profile_axes = {ax: make_profile_axes(ax) for ax in (ax1, ax2, ax3)}
+
+# Progressive rendering: the first frame is coarse (outlines and highlights, no
+# basemap, labels or overlays) so the window appears at once; the refined frame
+# follows as soon as the window is up, and again when the basemap has been fetched
+full_detail = [False]
+basemap = BasemapLoader(fig.canvas, total_bounds(cell_bounds),
+                        on_ready=lambda: scheduler.request((current_day[0], int(slider.val)), force=True))
+
+# Region and city outlines, built once per axes and re-added after every cla()
+region_outlines = {ax: box_outlines(cell_bounds, colors='lightgray', linewidths=0.4, zorder=1)
+                   for ax in (ax1, ax2, ax3)}
+city_outlines = {ax: outline_collection(city_gdf.geometry, colors='blue', linewidths=2, zorder=4)
+                 for ax in (ax1, ax2, ax3)}
+
+def draw_outlines(ax):
+    ax.add_collection(region_outlines[ax])
+    ax.add_collection(city_outlines[ax], autolim=False)
+    ax.set_aspect('equal')
+
+
+def hours_text(hour):
+    if window_hours[0] == 1:
+        return f"Hour {hour:02d}:00"
+    return f"Hours {hour:02d}:00-{(hour + window_hours[0]) % 24:02d}:00"
+
+# Top lists for the current window and K; single hours slice the stored rankings
+def top_lists(day, hour):
+    if window_hours[0] == 1:
+        return [od.top_regions(day, hour, num_top[0], measure) for measure in ['origin', 'destination', 'combined']]
+    return [hour_index.top_regions(day, hour, window_hours[0], num_top[0], measure)
+            for measure in ['origin', 'destination', 'combined']]
+
+
+# Outline the picked region and show its top links and 24-hour profile on its panel
+@timed_frame('pick')
+def draw_pick(hour):
+    for artist in pick_artists:
+        artist.remove()
+    pick_artists.clear()
+    for profile_ax, bars in profile_axes.values():
+        profile_ax.set_visible(False)
+    if picked[0] is None:
+        return
+    ax, measure, idx = picked[0]
+    day = current_day[0]
+    minx, miny, maxx, maxy = cell_bounds[idx]
+    pick_artists.append(ax.add_patch(Rectangle((minx, miny), maxx - minx, maxy - miny, fill=False,
+                                               edgecolor='magenta', linewidth=2.5, zorder=6)))
+
+    lines = [f"Region {od.grid.labels[idx]}"]
+    directions = {'origin': ['destinations'], 'destination': ['origins'], 'combined': ['destinations', 'origins']}
+    for direction in directions[measure]:
+        links = od.top_links(day, hour, idx, NUM_PICK_LINKS, direction)
+        lines.append(f"Top {direction}: " + (', '.join(f"{region} ({count})" for region, count in links) or 'none'))
+    pick_artists.append(ax.text(0.01, 0.01, '\n'.join(lines), transform=ax.transAxes, fontsize=10, va='bottom',
+                                ha='left', zorder=7, bbox=dict(facecolor='white', alpha=0.8, edgecolor='magenta')))
+
+    profile = hour_index.profile(day, idx, measure)
+    profile_ax, bars = profile_axes[ax]
+    for h, (bar, value) in enumerate(zip(bars, profile)):
+        bar.set_height(value)
+        bar.set_color('magenta' if h == hour else 'gray')
+    profile_ax.set_ylim(0, max(profile.max(), 1) * 1.05)
+    profile_ax.set_title(f"Region {od.grid.labels[idx]}, 24h {measure}", fontsize=8)
+    profile_ax.set_visible(True)
+
+
+def on_click(event):
+    if event.inaxes not in (ax1, ax2, ax3) or event.xdata is None:
+        return
+    if fig.canvas.toolbar is not None and fig.canvas.toolbar.mode:
+        return
+    idx = od.grid.region_at(event.xdata, event.ydata) if event.button == 1 else -1
+    measure = {ax1: 'origin', ax2: 'destination', ax3: 'combined'}[event.inaxes]
+    picked[0] = (event.inaxes, measure, idx) if idx >= 0 else None
+    draw_pick(int(slider.val))
+    fig.canvas.draw_idle()
 
 
 # Plot function
+@timed_frame()
 def plot_highlight(hour):
     # Set main title with day and hour
-    fig.suptitle(f"Top {NUM_TOP} Regions for {pretty_day[current_day[0]]}, Hour {hour:02d}:00", fontsize=18, y=0.97)
-    for ax, top_regions, title in zip(
+    fig.suptitle(f"Top {num_top[0]} Regions for {pretty_day[current_day[0]]}, {hours_text(hour)}", fontsize=18, y=0.97)
+    for ax, top_regions, title, measure in zip(
         [ax1, ax2, ax3],
-        [top_origins_per_file[current_day[0]][hour], top_destinations_per_file[current_day[0]][hour], top_combined_per_file[current_day[0]][hour]],
-        ["Origins", "Destinations", "Combined"]):
+        top_lists(current_day[0], hour),
+        ["Origins", "Destinations", "Combined"],
+        ['origin', 'destination', 'combined']):
         ax.cla()
-        region_indices = [region for region, count in top_regions if region in gdf.index]
-        highlight = gdf.loc[region_indices]
-        gdf.plot(ax=ax, facecolor="none", edgecolor="lightgray", linewidth=0.4)
-        cmap = plt.get_cmap('RdYlGn')
-        colors = [cmap(i / (len(highlight)-1)) for i in range(len(highlight))] if len(highlight) > 1 else ['red']*len(highlight)
-        for i, (region_id, row) in enumerate(highlight.iterrows()):
-            gpd.GeoSeries([row.geometry]).plot(ax=ax, facecolor=colors[i], edgecolor='black', linewidth=1, zorder=3)
-            c = row.centroid
-            ax.text(c.x, c.y, str(i+1), fontsize=8, color="black", ha="center", zorder=5)
-        # Overlay city boundary in blue
-        city_gdf.boundary.plot(ax=ax, color='blue', linewidth=2, zorder=4)
-        ctx.add_basemap(ax, source=ctx.providers.CartoDB.Voyager)
+        highlight = np.array([od.grid.index_of(region) for region, count in top_regions], dtype=np.int64)
+        highlight = highlight[highlight >= 0]
+        draw_outlines(ax)
+        if heatmap_mode[0]:
+            # Every region's intensity as one image, top regions only numbered
+            draw_heatmap(ax, od.grid, hour_index.window_totals(current_day[0], hour, window_hours[0], measure), smoothing=heatmap_smoothing[0])
+            for i, (x, y) in enumerate(centroids[highlight]):
+                ax.text(x, y, str(i+1), fontsize=8, color="black", ha="center", zorder=5)
+        else:
+            cmap = plt.get_cmap('RdYlGn')
+            colors = [cmap(i / (len(highlight)-1)) for i in range(len(highlight))] if len(highlight) > 1 else ['red']*len(highlight)
+            # All highlighted polygons in one plot call
+            if len(highlight):
+                ax.add_collection(box_patches(cell_bounds[highlight], facecolors=colors, edgecolors='black',
+                                              linewidths=1, zorder=3))
+            for i, (x, y) in enumerate(centroids[highlight]):
+                ax.text(x, y, str(i+1), fontsize=8, color="black", ha="center", zorder=5)
+        # Basemap from the background fetch, once it is ready
+        with phase('basemap'):
+            basemap.draw(ax)
         ax.set_title(title, fontsize=15, pad=18)
         ax.set_axis_off()
+        # The coarse first frame stops here; labels and overlays follow in the refined frame
+        if not full_detail[0]:
+            continue
         # Add label for #1 and #50
-        if len(top_regions) >= NUM_TOP:
+        if len(top_regions) >= num_top[0]:
             trip1 = top_regions[0][1]
-            trip50 = top_regions[NUM_TOP-1][1]
-            ax.text(0.01, 0.99, f"#1: {trip1} trips\n#{NUM_TOP}: {trip50} trips", transform=ax.transAxes,
+            trip50 = top_regions[num_top[0]-1][1]
+            ax.text(0.01, 0.99, f"#1: {trip1} trips\n#{num_top[0]}: {trip50} trips", transform=ax.transAxes,
                     fontsize=14, color="black", va="top", ha="left",
                     bbox=dict(facecolor='white', alpha=0.7, edgecolor='none'))
         elif len(top_regions) > 0:
@@ -260,29 +250,36 @@ def plot_highlight(hour):
             ax.text(0.01, 0.99, f"#1: {trip1} trips", transform=ax.transAxes,
                     fontsize=14, color="black", va="top", ha="left",
                     bbox=dict(facecolor='white', alpha=0.7, edgecolor='none'))
-        # Overlay BRT stations if toggled
-        if overlay_brt[0]:
-            xs, ys = zip(*brt_xy)
-            ax.scatter(xs, ys, c='deepskyblue', s=80, marker='o', edgecolor='black', zorder=10, label='BRT Station')
-        # Overlay POIs if toggled
-        if overlay_landmarks[0]:
-            for i, (landmark, (x, y)) in enumerate(zip(landmark_data, landmark_xy)):
-                ax.scatter(x, y, c=landmark['color'], s=100, marker='o', edgecolor='black', zorder=11)
-                ax.text(x, y, landmark['name'], fontsize=3.5, color='white', ha='center', va='center', 
-                       weight='bold', zorder=12, bbox=dict(facecolor='black', alpha=0.7, edgecolor='none', pad=1))
+        # Overlay BRT stations and landmarks (shown only if toggled on)
+        overlays.attach(ax)
+    # cla() already removed the previous pick artists
+    pick_artists.clear()
+    if full_detail[0]:
+        draw_pick(hour)
     plt.draw()
 
-plot_highlight(0)
+# Coalesce slider, button and keyboard events; only the latest (day, hour) is rendered
+scheduler = RenderScheduler(fig.canvas, lambda day, hour: plot_highlight(hour))
+scheduler.render_now((current_day[0], 0))
+
+# Refine the coarse first frame once the event loop is running
+def refine():
+    full_detail[0] = True
+    scheduler.request((current_day[0], int(slider.val)), force=True)
+refine_timer = fig.canvas.new_timer(interval=1)
+refine_timer.single_shot = True
+refine_timer.add_callback(refine)
+refine_timer.start()
 
 # Slider update
 def update(val):
-    plot_highlight(int(slider.val))
+    scheduler.request((current_day[0], int(slider.val)))
 slider.on_changed(update)
 
     # Function to switch day type
 def switch_day(day, button):
     current_day[0] = day
-    plot_highlight(int(slider.val))
+    scheduler.request((current_day[0], int(slider.val)))
 
 # Button callbacks
 def make_button_callback(day, button):
@@ -298,23 +295,59 @@ switch_day('W', buttons[0])
 
 # BRT toggle button callback
 def toggle_brt(event):
-    overlay_brt[0] = not overlay_brt[0]
-    plot_highlight(int(slider.val))
+    overlays.toggle('brt')
 brt_button.on_clicked(toggle_brt)
 
 # POI toggle button callback
 def toggle_poi(event):
-    overlay_landmarks[0] = not overlay_landmarks[0]
-    plot_highlight(int(slider.val))
+    overlays.toggle('landmarks')
 poi_button.on_clicked(toggle_poi)
 
+# Heatmap toggle button callback
+def toggle_heatmap(event):
+    heatmap_mode[0] = not heatmap_mode[0]
+    scheduler.request((current_day[0], int(slider.val)), force=True)
+heatmap_button.on_clicked(toggle_heatmap)
+
+# Window toggle button callback
+def toggle_window(event=None):
+    window_hours[0] = WINDOW_WIDTHS[(WINDOW_WIDTHS.index(window_hours[0]) + 1) % len(WINDOW_WIDTHS)]
+    window_button.label.set_text(f"Window\n{window_hours[0]}h")
+    scheduler.request((current_day[0], int(slider.val)), force=True)
+window_button.on_clicked(toggle_window)
+
+# K box callback: accept a positive whole number, otherwise restore the current K
+def set_top(text):
+    try:
+        k = int(text)
+    except ValueError:
+        k = 0
+    if k < 1:
+        k_box.set_val(str(num_top[0]))
+        return
+    num_top[0] = k
+    scheduler.request((current_day[0], int(slider.val)), force=True)
+k_box.on_submit(set_top)
+
 
 # Keyboard event handler for arrow keys
 def on_key(event):
+    # Keys typed into the K box are not shortcuts
+    if k_box.capturekeystrokes:
+        return
     if event.key == 'left':
         slider.set_val((slider.val - 1) % 24)
     elif event.key == 'right':
         slider.set_val((slider.val + 1) % 24)
+    elif event.key == 's' and heatmap_mode[0]:
+        heatmap_smoothing[0] = (heatmap_smoothing[0] + 1) % 3
+        scheduler.request((current_day[0], int(slider.val)), force=True)
+    elif event.key == 'escape' and picked[0] is not None:
+        picked[0] = None
+        draw_pick(int(slider.val))
+        fig.canvas.draw_idle()
+    elif event.key == 'w':
+        toggle_window()
     elif event.key == 'tab':
         if (current_day[0] == 'W'):
             switch_day('SAT', buttons[1])
@@ -327,5 +360,6 @@ def on_key(event):
 
 # Connect the key press event
 fig.canvas.mpl_connect('key_press_event', on_key)
+fig.canvas.mpl_connect('button_press_event', on_click)
 
 plt.show()
\ No newline at end of file
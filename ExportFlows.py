@@ -0,0 +1,101 @@
+# Export every day type and hour as compact binary flow buffers for
+# browser-side rendering (see flows.html).
+#
+# Each (day, hour) slice becomes one file, "{day}{hour}.bin", so a page only
+# fetches the hour it shows. Flows are sorted by trips (rank 0 = busiest) and
+# stored as consecutive little-endian sections:
+#   positions  float32[count * 4]  origin x, origin y, destination x, destination y
+#                                  (EPSG:3857 metres relative to index.json "origin",
+#                                  which keeps float32 precision well under a metre)
+#   trips      float32[count]
+#   rank       uint32[count]
+# index.json lists every file with its flow count and section byte offsets, so
+# the page can wrap each section in a typed array without copying.
+#
+# Usage: python ExportFlows.py [--out flows_export] [--non-adjacent] [--top N]
+#        then serve the folder (python -m http.server -d flows_export) and open flows.html
+
+import argparse
+import json
+import os
+import shutil
+import numpy as np
+from Grid import centroids_3857
+from ODData import day_types, HOURS
+from SharedOD import open_shared
+
+EXPORT_DIR = 'flows_export'
+PAGE = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'flows.html')
+
+
+def export_slice(od, day, hour, centroids, origin, path, non_adjacent=False, top=None):
+    origins, dests, trips = od.entries(day, hour, non_adjacent=non_adjacent)
+    keep = trips > 0
+    origins, dests, trips = origins[keep], dests[keep], trips[keep]
+    order = np.argsort(-trips, kind='stable')
+    if top:
+        order = order[:top]
+    origins, dests, trips = origins[order], dests[order], trips[order]
+    count = len(trips)
+
+    positions = np.empty((count, 4), dtype='<f4')
+    positions[:, 0:2] = centroids[origins] - origin
+    positions[:, 2:4] = centroids[dests] - origin
+    sections = [
+        ('positions', positions.ravel()),
+        ('trips', trips.astype('<f4')),
+        ('rank', np.arange(count, dtype='<u4')),
+    ]
+
+    entry = {'file': os.path.basename(path), 'count': count,
+             'max_trips': float(trips[0]) if count else 0.0, 'total_trips': float(trips.sum())}
+    offset = 0
+    with open(path, 'wb') as f:
+        for name, array in sections:
+            entry[name] = {'offset': offset, 'length': int(array.size)}
+            f.write(array.tobytes())
+            offset += array.nbytes
+    entry['bytes'] = offset
+    return entry
+
+
+def export_flows(od, out_dir=EXPORT_DIR, non_adjacent=False, top=None):
+    os.makedirs(out_dir, exist_ok=True)
+    centroids = centroids_3857(od.grid)
+    origin = centroids.mean(axis=0).round()
+    slices = {}
+    for day in day_types:
+        for hour in range(HOURS):
+            path = os.path.join(out_dir, f"{day}{hour}.bin")
+            slices[f"{day}{hour}"] = export_slice(od, day, hour, centroids, origin, path, non_adjacent, top)
+
+    extent = np.concatenate([centroids.min(axis=0) - origin, centroids.max(axis=0) - origin])
+    index = {
+        'crs': 'EPSG:3857',
+        'origin': origin.tolist(),
+        'extent': extent.tolist(),
+        'day_types': day_types,
+        'hours': HOURS,
+        'weekday_weight': od.weekday_weight,
+        'non_adjacent': non_adjacent,
+        'layout': ['positions:float32x4', 'trips:float32', 'rank:uint32'],
+        'slices': slices,
+    }
+    with open(os.path.join(out_dir, 'index.json'), 'w') as f:
+        json.dump(index, f, indent=1)
+    shutil.copy(PAGE, os.path.join(out_dir, 'flows.html'))
+    return index
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Export OD flows as binary buffers for WebGL rendering.")
+    parser.add_argument('--out', default=EXPORT_DIR)
+    parser.add_argument('--weekday-weight', type=float, default=1.0)
+    parser.add_argument('--non-adjacent', action='store_true', help="Drop same-cell and neighbouring-cell pairs")
+    parser.add_argument('--top', type=int, default=None, help="Keep only the busiest N flows per hour")
+    args = parser.parse_args()
+
+    od = open_shared(weekday_weight=args.weekday_weight)
+    index = export_flows(od, args.out, args.non_adjacent, args.top)
+    total = sum(entry['bytes'] for entry in index['slices'].values())
+    print(f"Wrote {len(index['slices'])} hourly flow files ({total / 1e6:.1f} MB) to {args.out}")
@@ -0,0 +1,121 @@
+# Regular grid structure of the MAP.json regions.
+# Every region is an axis-aligned lon/lat cell of the same size, so each one
+# can be described by a (row, col) position instead of its polygon. This is
+# used for adjacency tests and region-id lookups without touching geometry.
+
+import json
+import numpy as np
+
+
+class RegionGrid:
+    def __init__(self, labels, rows, cols, lon0, lat0, dlon, dlat):
+        self.labels = np.asarray(labels, dtype=np.int64)   # "Region N" -> N, in MAP.json order
+        self.rows = np.asarray(rows, dtype=np.int64)       # row 0 is the southern edge
+        self.cols = np.asarray(cols, dtype=np.int64)       # col 0 is the western edge
+        self.lon0 = lon0
+        self.lat0 = lat0
+        self.dlon = dlon
+        self.dlat = dlat
+        self.n_rows = int(self.rows.max()) + 1
+        self.n_cols = int(self.cols.max()) + 1
+
+        # Lookup from region number to dense index (-1 if not in the map)
+        self.label_to_index = np.full(int(self.labels.max()) + 1, -1, dtype=np.int64)
+        self.label_to_index[self.labels] = np.arange(len(self.labels))
+
+        # Lookup from (row, col) cell to dense index (-1 if no region there)
+        self.cell_to_index = np.full((self.n_rows, self.n_cols), -1, dtype=np.int64)
+        self.cell_to_index[self.rows, self.cols] = np.arange(len(self.labels))
+
+    @property
+    def n_regions(self):
+        return len(self.labels)
+
+    def index_of(self, label):
+        if label < 0 or label >= len(self.label_to_index):
+            return -1
+        return int(self.label_to_index[label])
+
+    # Same rule as is_adjacent_or_same: same cell, or touching by an edge or a corner
+    def adjacent_or_same(self, origin_idx, dest_idx):
+        origin_idx = np.asarray(origin_idx)
+        dest_idx = np.asarray(dest_idx)
+        drow = np.abs(self.rows[origin_idx] - self.rows[dest_idx])
+        dcol = np.abs(self.cols[origin_idx] - self.cols[dest_idx])
+        return (drow <= 1) & (dcol <= 1)
+
+    # Region index under EPSG:3857 point(s) by grid arithmetic, -1 outside every region
+    def region_at(self, x, y):
+        lon, lat = mercator_to_lonlat(x, y)
+        col = np.floor((lon - self.lon0) / self.dlon).astype(np.int64)
+        row = np.floor((lat - self.lat0) / self.dlat).astype(np.int64)
+        inside = (row >= 0) & (row < self.n_rows) & (col >= 0) & (col < self.n_cols)
+        index = np.where(inside, self.cell_to_index[np.where(inside, row, 0), np.where(inside, col, 0)], -1)
+        return int(index) if index.ndim == 0 else index
+
+
+def _region_label(properties, fallback):
+    name = properties.get('name')
+    if isinstance(name, str) and name.startswith('Region '):
+        return int(name.replace('Region ', ''))
+    return int(properties.get('id', fallback))
+
+
+def load_grid(geo_path="MAP.json"):
+    with open(geo_path, 'r') as f:
+        geojson = json.load(f)
+
+    labels = []
+    min_lon = []
+    min_lat = []
+    for i, feature in enumerate(geojson.get('features', [])):
+        labels.append(_region_label(feature.get('properties', {}), i))
+        ring = np.asarray(feature['geometry']['coordinates'][0], dtype=np.float64)
+        min_lon.append(ring[:, 0].min())
+        min_lat.append(ring[:, 1].min())
+    min_lon = np.array(min_lon)
+    min_lat = np.array(min_lat)
+
+    # Cell size is the smallest non-zero step between cell corners
+    def step(values):
+        steps = np.diff(np.unique(np.round(values, 9)))
+        return float(steps[steps > 1e-9].min())
+
+    dlon = step(min_lon)
+    dlat = step(min_lat)
+    lon0 = float(min_lon.min())
+    lat0 = float(min_lat.min())
+    cols = np.rint((min_lon - lon0) / dlon).astype(np.int64)
+    rows = np.rint((min_lat - lat0) / dlat).astype(np.int64)
+    return RegionGrid(labels, rows, cols, lon0, lat0, dlon, dlat)
+
+
+# Spherical Web Mercator (EPSG:3857), the projection the viewers draw in
+EARTH_RADIUS = 6378137.0
+
+
+def lonlat_to_mercator(lon, lat):
+    lon = np.asarray(lon, dtype=np.float64)
+    lat = np.asarray(lat, dtype=np.float64)
+    x = EARTH_RADIUS * np.radians(lon)
+    y = EARTH_RADIUS * np.log(np.tan(np.pi / 4 + np.radians(lat) / 2))
+    return x, y
+
+
+def mercator_to_lonlat(x, y):
+    lon = np.degrees(np.asarray(x, dtype=np.float64) / EARTH_RADIUS)
+    lat = np.degrees(2 * np.arctan(np.exp(np.asarray(y, dtype=np.float64) / EARTH_RADIUS)) - np.pi / 2)
+    return lon, lat
+
+
+# Cell bounds (minx, miny, maxx, maxy) in EPSG:3857. The cells stay axis-aligned
+# rectangles after projection, so their centroids are the bound midpoints.
+def cell_bounds_3857(grid):
+    minx, miny = lonlat_to_mercator(grid.lon0 + grid.cols * grid.dlon, grid.lat0 + grid.rows * grid.dlat)
+    maxx, maxy = lonlat_to_mercator(grid.lon0 + (grid.cols + 1) * grid.dlon, grid.lat0 + (grid.rows + 1) * grid.dlat)
+    return np.column_stack([minx, miny, maxx, maxy])
+
+
+def centroids_3857(grid):
+    bounds = cell_bounds_3857(grid)
+    return np.column_stack([(bounds[:, 0] + bounds[:, 2]) / 2, (bounds[:, 1] + bounds[:, 3]) / 2])
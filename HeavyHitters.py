@@ -0,0 +1,95 @@
+# Streaming heavy-hitter tracking for OD keys in fixed memory.
+# SpaceSaving keeps at most `capacity` counters no matter how many distinct
+# (origin, destination[, hour]) keys the stream contains. Every reported count
+# overestimates the true count by at most its recorded error, and that error
+# is never more than total / capacity, so any key with more than
+# total / capacity trips is guaranteed to be tracked.
+#
+# Updates are done in batches (one whole hourly file at a time): the batch is
+# pre-aggregated with NumPy, keys already tracked are incremented in place and
+# new keys compete for the smallest counters.
+
+import heapq
+import numpy as np
+
+
+class SpaceSaving:
+    def __init__(self, capacity):
+        if capacity < 1:
+            raise ValueError("capacity must be at least 1")
+        self.capacity = capacity
+        self.counts = {}     # key -> estimated count (upper bound)
+        self.errors = {}     # key -> maximum overestimate of that count
+        self.total = 0.0
+
+    # Add one batch of integer keys with weights
+    def update(self, keys, weights):
+        keys = np.asarray(keys, dtype=np.int64)
+        weights = np.asarray(weights, dtype=np.float64)
+        if len(keys) == 0:
+            return
+        unique, inverse = np.unique(keys, return_inverse=True)
+        sums = np.bincount(inverse, weights=weights)
+        self.total += float(sums.sum())
+
+        counts = self.counts
+        new_keys = []
+        for key, value in zip(unique.tolist(), sums.tolist()):
+            if key in counts:
+                counts[key] += value
+            else:
+                new_keys.append((value, key))
+
+        # Fill free slots with the heaviest new keys first
+        new_keys.sort(reverse=True)
+        free = self.capacity - len(counts)
+        for value, key in new_keys[:free]:
+            counts[key] = value
+            self.errors[key] = 0.0
+        rest = new_keys[max(free, 0):]
+        if not rest:
+            return
+
+        # Each remaining new key replaces the current minimum counter and
+        # inherits its count as error, as in the one-at-a-time algorithm
+        heap = [(value, key) for key, value in counts.items()]
+        heapq.heapify(heap)
+        for value, key in rest:
+            floor, evicted = heapq.heappop(heap)
+            del counts[evicted]
+            del self.errors[evicted]
+            counts[key] = floor + value
+            self.errors[key] = floor
+            heapq.heappush(heap, (floor + value, key))
+
+    # Guaranteed bound on the overestimate of any reported count
+    def error_bound(self):
+        return self.total / self.capacity
+
+    # Top n as [(key, estimated count, error)], largest first
+    def top(self, n):
+        items = heapq.nlargest(n, self.counts.items(), key=lambda x: x[1])
+        return [(key, count, self.errors[key]) for key, count in items]
+
+    # True if the ranking of the top n is certain: each reported lower bound
+    # (count - error) beats the (n+1)-th estimated count
+    def top_is_exact(self, n):
+        items = heapq.nlargest(n + 1, self.counts.items(), key=lambda x: x[1])
+        if len(items) <= n:
+            return True
+        threshold = items[n][1]
+        return all(count - self.errors[key] >= threshold for key, count in items[:n])
+
+
+# Pack / unpack (origin, destination[, hour]) index tuples into single integer keys
+def pack_keys(origins, dests, n_regions, hours=None):
+    keys = np.asarray(origins, dtype=np.int64) * n_regions + np.asarray(dests, dtype=np.int64)
+    if hours is not None:
+        keys = np.asarray(hours, dtype=np.int64) * n_regions * n_regions + keys
+    return keys
+
+
+def unpack_key(key, n_regions):
+    hour, rest = divmod(int(key), n_regions * n_regions)
+    origin, dest = divmod(rest, n_regions)
+    return origin, dest, hour
@@ -0,0 +1,169 @@
+# Prefix sums over the hour axis, for hour-range and region-set queries.
+# For every day type the index keeps cumulative origin / destination totals
+# (25 x n, row h = sum of hours before h) and, built on first use, cumulative
+# OD matrices. Any hour range is then one subtraction of two prefix rows:
+#   totals over [start, end)   ->  O(n), or O(len(regions)) for a region set
+#   trip total over [start, end) ->  O(1)
+#   OD submatrix over [start, end) -> two (three if wrapping) sparse slices
+# Ranges are [start, end) in hours; end <= start wraps past midnight, so
+# (22, 2) is 22:00-01:59 and (0, 24) is the whole day.
+#
+# Usage: python HourIndex.py --day W --hours 7-10 [--regions 12,40,41] [--top 10]
+
+import argparse
+import numpy as np
+import scipy.sparse as sp
+from ODData import day_types, HOURS, measures, as_count, top_indices
+
+
+def _span(start, end):
+    start %= HOURS
+    length = (end - start) % HOURS or HOURS
+    return start, start + length
+
+
+# Prefix rows a range reads: two, or three when it wraps past midnight
+def _prefix_rows(start, end):
+    start, end = _span(start, end)
+    return {start, end} if end <= HOURS else {start, HOURS, end - HOURS}
+
+
+def _range_sum(cum, start, end):
+    start, end = _span(start, end)
+    if end <= HOURS:
+        return cum[end] - cum[start]
+    return (cum[HOURS] - cum[start]) + cum[end - HOURS]
+
+
+class HourIndex:
+    def __init__(self, od):
+        self.od = od
+        self.grid = od.grid
+        self.origin = {}          # {day: (25, n) cumulative origin totals}
+        self.destination = {}     # {day: (25, n) cumulative destination totals}
+        self.trips = {}           # {day: (25,) cumulative trip totals}
+        self._matrices = {}       # {day: [25 cumulative CSR matrices]}, built on first use
+        n = od.n_regions
+        for day in day_types:
+            origin = np.zeros((HOURS + 1, n))
+            destination = np.zeros((HOURS + 1, n))
+            for hour in range(HOURS):
+                origin[hour + 1] = origin[hour] + od.origin_totals(day, hour)
+                destination[hour + 1] = destination[hour] + od.destination_totals(day, hour)
+            self.origin[day] = origin
+            self.destination[day] = destination
+            self.trips[day] = origin.sum(axis=1)
+
+    def _cumulative_matrices(self, day):
+        if day not in self._matrices:
+            n = self.od.n_regions
+            cum = [sp.csr_matrix((n, n))]
+            for hour in range(HOURS):
+                cum.append((cum[-1] + sp.csr_matrix(self.od.matrix(day, hour))).tocsr())
+            self._matrices[day] = cum
+        return self._matrices[day]
+
+    def _indices(self, regions):
+        indices = np.array([self.grid.index_of(r) for r in regions], dtype=np.int64)
+        missing = [r for r, i in zip(regions, indices) if i < 0]
+        if missing:
+            raise KeyError(f"Unknown regions: {missing}")
+        return indices
+
+    def trip_total(self, day, start, end):
+        return float(_range_sum(self.trips[day], start, end))
+
+    def origin_totals(self, day, start, end):
+        return _range_sum(self.origin[day], start, end)
+
+    def destination_totals(self, day, start, end):
+        return _range_sum(self.destination[day], start, end)
+
+    def totals(self, day, start, end, measure='origin'):
+        if measure == 'origin':
+            return self.origin_totals(day, start, end)
+        if measure == 'destination':
+            return self.destination_totals(day, start, end)
+        if measure == 'combined':
+            return self.origin_totals(day, start, end) + self.destination_totals(day, start, end)
+        raise ValueError(f"Unknown measure: {measure}")
+
+    # Total over a set of region numbers, touching only their prefix columns
+    def region_total(self, day, start, end, regions, measure='origin'):
+        indices = self._indices(regions)
+        columns = {'origin': [self.origin[day]], 'destination': [self.destination[day]],
+                   'combined': [self.origin[day], self.destination[day]]}
+        if measure not in columns:
+            raise ValueError(f"Unknown measure: {measure}")
+        return float(sum(_range_sum(cum[:, indices], start, end).sum() for cum in columns[measure]))
+
+    # Trips from the origin set to the destination set over [start, end), as a
+    # CSR matrix whose rows / columns follow the given region numbers (all regions if None)
+    def submatrix(self, day, start, end, origins=None, dests=None):
+        rows = self._indices(origins) if origins is not None else slice(None)
+        cols = self._indices(dests) if dests is not None else slice(None)
+        matrices = self._cumulative_matrices(day)
+        cum = {h: matrices[h][rows][:, cols] for h in _prefix_rows(start, end)}
+        return _range_sum(cum, start, end).tocsr()
+
+    # Hour-by-hour values of one region (24 values) from the prefix columns
+    def profile(self, day, region_idx, measure='origin'):
+        if measure == 'combined':
+            return self.profile(day, region_idx, 'origin') + self.profile(day, region_idx, 'destination')
+        cum = {'origin': self.origin, 'destination': self.destination}[measure][day]
+        return np.diff(cum[:, region_idx])
+
+    # Rolling window of `width` hours starting at `hour`; with change=True the
+    # difference to the following window, which for width 1 is ODStore.delta
+    def window_totals(self, day, hour, width, measure='origin', change=False):
+        values = self.totals(day, hour, hour + width, measure)
+        if change:
+            values = values - self.totals(day, hour + width, hour + 2 * width, measure)
+        return values
+
+    def top_regions(self, day, hour, width, k, measure='origin', change=False):
+        values = self.window_totals(day, hour, width, measure, change)
+        return [(int(self.grid.labels[i]), as_count(values[i])) for i in top_indices(values, k)]
+
+    def top_pairs(self, day, hour, width, k, non_adjacent=False):
+        m = self.submatrix(day, hour, hour + width).tocoo()
+        origins, dests, values = m.row.astype(np.int64), m.col.astype(np.int64), m.data
+        if non_adjacent:
+            keep = ~self.grid.adjacent_or_same(origins, dests)
+            origins, dests, values = origins[keep], dests[keep], values[keep]
+        labels = self.grid.labels
+        return [((int(labels[origins[i]]), int(labels[dests[i]])), as_count(values[i]))
+                for i in top_indices(values, k)]
+
+
+def _parse_hours(text):
+    start, _, end = text.partition('-')
+    return int(start), int(end) if end else int(start) + 1
+
+
+if __name__ == '__main__':
+    from SharedOD import open_shared
+
+    parser = argparse.ArgumentParser(description="Totals and top regions for an hour range and region set.")
+    parser.add_argument('--day', choices=day_types, default='W')
+    parser.add_argument('--hours', default='0-24', help="START-END, end exclusive; wraps past midnight if END <= START")
+    parser.add_argument('--regions', default=None, help="Comma-separated region numbers to total over")
+    parser.add_argument('--top', type=int, default=10)
+    parser.add_argument('--weekday-weight', type=float, default=1.0)
+    args = parser.parse_args()
+
+    index = HourIndex(open_shared(weekday_weight=args.weekday_weight))
+    start, end = _parse_hours(args.hours)
+    span_start, span_end = _span(start, end)
+    print(f"{args.day} {span_start:02d}:00-{span_end % HOURS:02d}:00: {as_count(index.trip_total(args.day, start, end))} trips")
+    if args.regions:
+        regions = [int(r) for r in args.regions.split(',')]
+        for measure in measures:
+            print(f"  {measure} total over {len(regions)} regions: "
+                  f"{as_count(index.region_total(args.day, start, end, regions, measure))}")
+        inside = index.submatrix(args.day, start, end, regions, regions)
+        print(f"  trips within the set: {as_count(inside.sum())}")
+    for measure in measures:
+        values = index.totals(args.day, start, end, measure)
+        top = [(int(index.grid.labels[i]), as_count(values[i])) for i in top_indices(values, args.top)]
+        print(f"  top {measure}: {top}")
@@ -0,0 +1,192 @@
+# Opt-in timing and memory instrumentation.
+# Set WOD_PROFILE=report.json (or WOD_PROFILE=1 for profile_report.json) to
+# record wall time, call counts and peak Python memory for every phase
+# (ingest, aggregation, geometry load, basemap fetch, frame render). The JSON
+# report is written when the process exits; rendered frames are also logged
+# to stderr as they happen. When WOD_PROFILE is unset every hook is a no-op.
+# Memory tracking (tracemalloc) slows Python code down noticeably; set
+# WOD_PROFILE_MEMORY=0 to record timings only.
+#
+# tracemalloc keeps a single peak for the whole process, so a phase's peak is
+# only recorded for calls that ran while no other thread was inside a phase
+# (e.g. a single-worker ingest). Calls that overlapped another thread's phase
+# are counted as 'threaded_calls' and left out of 'peak_bytes'; the report's
+# 'peak_traced_bytes' is the process-wide peak.
+
+import atexit
+import functools
+import json
+import os
+import sys
+import threading
+import time
+import tracemalloc
+from contextlib import contextmanager
+
+PROFILE_ENV = 'WOD_PROFILE'
+DEFAULT_REPORT = 'profile_report.json'
+
+_setting = os.environ.get(PROFILE_ENV, '')
+enabled = _setting not in ('', '0')
+report_path = DEFAULT_REPORT if _setting in ('1', 'true', 'yes') else _setting
+track_memory = enabled and os.environ.get('WOD_PROFILE_MEMORY', '1') != '0'
+
+# name -> {'calls', 'total_s', 'max_s', 'peak_bytes', 'threaded_calls'}
+phases = {}
+# (name, label, seconds) for every rendered frame
+frames = []
+# name -> callable returning extra JSON-serialisable stats for the report
+sources = {}
+_local = threading.local()   # per-thread stack of [running peak, overlapped] for each open phase
+_stacks = {}                 # thread id -> that thread's stack
+_lock = threading.Lock()
+_process_peak = 0
+_started = time.perf_counter()
+
+
+def _traced_peak():
+    return tracemalloc.get_traced_memory()[1] if track_memory else 0
+
+
+def _stack_for_thread():
+    if not hasattr(_local, 'stack'):
+        _local.stack = []
+        with _lock:
+            _stacks[threading.get_ident()] = _local.stack
+    return _local.stack
+
+
+def _fold_peak(stack):
+    # Move the peak seen so far into the innermost open phase (and the process
+    # peak) before resetting it
+    global _process_peak
+    peak = _traced_peak()
+    _process_peak = max(_process_peak, peak)
+    if stack:
+        stack[-1][0] = max(stack[-1][0], peak)
+
+
+def _record(name, seconds, peak, overlapped):
+    with _lock:
+        stats = phases.setdefault(name, {'calls': 0, 'total_s': 0.0, 'max_s': 0.0, 'peak_bytes': 0,
+                                         'threaded_calls': 0})
+        stats['calls'] += 1
+        stats['total_s'] += seconds
+        stats['max_s'] = max(stats['max_s'], seconds)
+        if overlapped:
+            stats['threaded_calls'] += 1
+        else:
+            stats['peak_bytes'] = max(stats['peak_bytes'], peak)
+
+
+@contextmanager
+def _measured(name):
+    stack = _stack_for_thread()
+    with _lock:
+        # Phases open in other threads share the one tracemalloc peak with this
+        # call, so neither side's peak can be attributed
+        others = [s for s in _stacks.values() if s and s is not stack]
+        if others:
+            for s in others + [stack]:
+                for entry in s:
+                    entry[1] = True
+        _fold_peak(stack)
+        if track_memory:
+            tracemalloc.reset_peak()
+        stack.append([0, bool(others)])
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        seconds = time.perf_counter() - start
+        with _lock:
+            peak, overlapped = stack.pop()
+            peak = max(peak, _traced_peak())
+            if stack:
+                stack[-1][0] = max(stack[-1][0], peak)
+        _record(name, seconds, peak, overlapped)
+
+
+@contextmanager
+def _noop():
+    yield
+
+
+# Usage: with phase('geometry'): gdf = gpd.read_file(...)
+def phase(name):
+    return _measured(name) if enabled else _noop()
+
+
+# Decorator form of phase()
+def timed(name):
+    def wrap(func):
+        if not enabled:
+            return func
+
+        @functools.wraps(func)
+        def inner(*args, **kwargs):
+            with _measured(name):
+                return func(*args, **kwargs)
+        return inner
+    return wrap
+
+
+# Decorator for frame render functions: timed like a phase, and logged per frame
+def timed_frame(name='render'):
+    def wrap(func):
+        if not enabled:
+            return func
+
+        @functools.wraps(func)
+        def inner(*args, **kwargs):
+            start = time.perf_counter()
+            with _measured(name):
+                result = func(*args, **kwargs)
+            seconds = time.perf_counter() - start
+            label = ', '.join(str(a) for a in args)
+            frames.append((name, label, seconds))
+            print(f"[{name}] frame {len(frames)} ({label}): {seconds * 1000:.1f} ms", file=sys.stderr)
+            return result
+        return inner
+    return wrap
+
+
+# Include extra stats (e.g. render scheduler counts) in the report
+def add_source(name, source):
+    if enabled:
+        sources[name] = source
+
+
+def _max_rss_bytes():
+    try:
+        import resource
+    except ImportError:
+        return None
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # ru_maxrss is in bytes on macOS and in kilobytes on Linux
+    return rss if sys.platform == 'darwin' else rss * 1024
+
+
+def report():
+    return {
+        'script': os.path.basename(sys.argv[0]) if sys.argv else '',
+        'wall_s': time.perf_counter() - _started,
+        'max_rss_bytes': _max_rss_bytes(),
+        'peak_traced_bytes': max(_process_peak, _traced_peak()),
+        'phases': phases,
+        'frames': [{'phase': n, 'args': label, 'seconds': s} for n, label, s in frames],
+        **{name: source() for name, source in sources.items()},
+    }
+
+
+def write_report(path=None):
+    path = path or report_path
+    with open(path, 'w') as f:
+        json.dump(report(), f, indent=1)
+    print(f"Wrote profile report to {path}", file=sys.stderr)
+
+
+if enabled:
+    if track_memory:
+        tracemalloc.start()
+    atexit.register(write_report)
@@ -0,0 +1,204 @@
+# Low-rank compressed store for the stack of hourly OD slices.
+# The 72 base slices (W, SAT, SUN x 24 hours) are factorized together as a
+# rank-R CP (PARAFAC) model:
+#     X[t, i, j] ~ sum_r C[t, r] * A[i, r] * B[j, r]
+# A holds origin patterns, B destination patterns and C how strongly each
+# pattern is active in each slice, so storage is (2n + 72) * R numbers instead
+# of one n x n matrix per slice. A plain SVD of the stacked slices would still
+# keep R full n x n basis matrices, which is why the tensor form is used.
+#
+# Fitting is alternating least squares on the non-zero entries only, so it
+# never densifies a slice. Marginals and top-K queries are answered from the
+# factors; ALL and hour-over-hour changes are linear in C, so they are just
+# different slice weights.
+#
+# Usage: python LowRankOD.py --rank 20 [--iters 50] [--out od_lowrank.npz]
+
+import argparse
+import numpy as np
+import scipy.sparse as sp
+from ODData import day_types2, HOURS, as_count, top_indices
+from Grid import load_grid
+
+LOWRANK_PATH = 'od_lowrank.npz'
+
+
+def _slice_index(day, hour):
+    return day_types2.index(day) * HOURS + hour
+
+
+def _khatri_rao_rows(first, second, rows_first, rows_second):
+    return first[rows_first] * second[rows_second]
+
+
+class LowRankOD:
+    def __init__(self, grid, A, B, C, weekday_weight=1.0, slice_errors=None):
+        self.grid = grid
+        self.A = A
+        self.B = B
+        self.C = C
+        self.weekday_weight = weekday_weight
+        self.slice_errors = slice_errors if slice_errors is not None else np.full(len(C), np.nan)
+
+    @property
+    def rank(self):
+        return self.A.shape[1]
+
+    # Slice weights over the R components for a (day, hour), ALL and changes included
+    def weights(self, day, hour, change=False):
+        if day == 'ALL':
+            c = self.C[_slice_index('W', hour)] * self.weekday_weight
+            for other in day_types2[1:]:
+                c = c + self.C[_slice_index(other, hour)]
+        else:
+            c = self.C[_slice_index(day, hour)]
+        if change:
+            c = c - self.weights(day, (hour + 1) % HOURS)
+        return c
+
+    def origin_totals(self, day, hour, change=False):
+        return self.A @ (self.weights(day, hour, change) * self.B.sum(axis=0))
+
+    def destination_totals(self, day, hour, change=False):
+        return self.B @ (self.weights(day, hour, change) * self.A.sum(axis=0))
+
+    def totals(self, day, hour, measure='origin', change=False):
+        if measure == 'origin':
+            return self.origin_totals(day, hour, change)
+        if measure == 'destination':
+            return self.destination_totals(day, hour, change)
+        if measure == 'combined':
+            return self.origin_totals(day, hour, change) + self.destination_totals(day, hour, change)
+        raise ValueError(f"Unknown measure: {measure}")
+
+    def top_regions(self, day, hour, k, measure='origin', change=False):
+        values = self.totals(day, hour, measure, change)
+        return [(int(self.grid.labels[i]), as_count(round(values[i], 1))) for i in top_indices(values, k)]
+
+    # Approximate top-K OD pairs, scored block by block so no full n x n slice is built
+    def top_pairs(self, day, hour, k, non_adjacent=False, change=False, block=1024):
+        weighted = self.A * self.weights(day, hour, change)
+        n = self.grid.n_regions
+        best_values = np.empty(0)
+        best_origins = np.empty(0, dtype=np.int64)
+        best_dests = np.empty(0, dtype=np.int64)
+        for start in range(0, n, block):
+            rows = np.arange(start, min(start + block, n))
+            scores = weighted[rows] @ self.B.T
+            if non_adjacent:
+                scores[self.grid.adjacent_or_same(rows[:, None], np.arange(n)[None, :])] = -np.inf
+            flat = scores.ravel()
+            candidates = top_indices(flat, k)
+            best_values = np.concatenate([best_values, flat[candidates]])
+            best_origins = np.concatenate([best_origins, rows[candidates // n]])
+            best_dests = np.concatenate([best_dests, candidates % n])
+        labels = self.grid.labels
+        return [((int(labels[best_origins[i]]), int(labels[best_dests[i]])), as_count(round(best_values[i], 1)))
+                for i in top_indices(best_values, k)]
+
+    def stored_values(self):
+        return self.A.size + self.B.size + self.C.size
+
+    def save(self, path=LOWRANK_PATH):
+        np.savez(path, A=self.A, B=self.B, C=self.C, weekday_weight=self.weekday_weight,
+                 slice_errors=self.slice_errors)
+
+
+def load_lowrank(path=LOWRANK_PATH, geo_path="MAP.json"):
+    with np.load(path) as data:
+        return LowRankOD(load_grid(geo_path), data['A'], data['B'], data['C'],
+                         float(data['weekday_weight']), data['slice_errors'])
+
+
+# All base slices as one list of non-zero entries (slice, origin, destination, trips)
+def stack_entries(od):
+    parts = []
+    for day in day_types2:
+        for hour in range(HOURS):
+            origins, dests, values = od.entries(day, hour)
+            t = np.full(len(values), _slice_index(day, hour))
+            parts.append((t, origins, dests, values))
+    return [np.concatenate(column) for column in zip(*parts)]
+
+
+def slice_errors(entries, A, B, C):
+    t, i, j, x = entries
+    n_slices = len(C)
+    norm_sq = np.bincount(t, weights=x * x, minlength=n_slices)
+    inner = np.bincount(t, weights=x * np.einsum('nr,nr,nr->n', A[i], B[j], C[t]), minlength=n_slices)
+    gram = (A.T @ A) * (B.T @ B)
+    model_sq = np.einsum('tr,rs,ts->t', C, gram, C)
+    residual = np.maximum(norm_sq - 2 * inner + model_sq, 0.0)
+    return np.sqrt(residual) / np.maximum(np.sqrt(norm_sq), 1e-12)
+
+
+# CP-ALS on the non-zero entries; returns (A, B, C, per-slice relative errors, iterations used)
+def fit_cp(entries, n_regions, n_slices, rank, iters=50, tol=1e-5, seed=0):
+    t, i, j, x = entries
+    nnz = len(x)
+    rng = np.random.default_rng(seed)
+    A = rng.random((n_regions, rank))
+    B = rng.random((n_regions, rank))
+    C = rng.random((n_slices, rank))
+
+    # Selector matrices turn "sum over entries grouped by mode index" into one sparse product
+    select = {mode: sp.csr_matrix((x, (index, np.arange(nnz))), shape=(size, nnz))
+              for mode, index, size in (('A', i, n_regions), ('B', j, n_regions), ('C', t, n_slices))}
+
+    norm = np.sqrt((x * x).sum())
+    previous_fit = None
+    for iteration in range(1, iters + 1):
+        A = (select['A'] @ _khatri_rao_rows(B, C, j, t)) @ np.linalg.pinv((B.T @ B) * (C.T @ C))
+        B = (select['B'] @ _khatri_rao_rows(A, C, i, t)) @ np.linalg.pinv((A.T @ A) * (C.T @ C))
+        C = (select['C'] @ _khatri_rao_rows(A, B, i, j)) @ np.linalg.pinv((A.T @ A) * (B.T @ B))
+
+        # Keep A and B unit-norm so the slice weights in C carry the scale
+        scale_a = np.linalg.norm(A, axis=0)
+        scale_b = np.linalg.norm(B, axis=0)
+        scale_a[scale_a == 0] = 1
+        scale_b[scale_b == 0] = 1
+        A /= scale_a
+        B /= scale_b
+        C *= scale_a * scale_b
+
+        inner = (x * np.einsum('nr,nr,nr->n', A[i], B[j], C[t])).sum()
+        model_sq = np.einsum('tr,rs,ts->', C, (A.T @ A) * (B.T @ B), C)
+        fit = 1 - np.sqrt(max(norm ** 2 - 2 * inner + model_sq, 0)) / norm
+        if previous_fit is not None and abs(fit - previous_fit) < tol:
+            break
+        previous_fit = fit
+
+    return A, B, C, slice_errors(entries, A, B, C), iteration
+
+
+def compress(od, rank, iters=50, tol=1e-5, seed=0):
+    entries = stack_entries(od)
+    A, B, C, errors, used = fit_cp(entries, od.n_regions, len(day_types2) * HOURS, rank, iters, tol, seed)
+    lowrank = LowRankOD(od.grid, A, B, C, od.weekday_weight, errors)
+    lowrank.iterations = used
+    lowrank.source_nnz = len(entries[3])
+    return lowrank
+
+
+if __name__ == '__main__':
+    from SharedOD import open_shared
+
+    parser = argparse.ArgumentParser(description="Compress the hourly OD slices into a rank-R CP model.")
+    parser.add_argument('--rank', type=int, required=True)
+    parser.add_argument('--iters', type=int, default=50)
+    parser.add_argument('--weekday-weight', type=float, default=1.0)
+    parser.add_argument('--out', default=LOWRANK_PATH)
+    args = parser.parse_args()
+
+    od = open_shared(weekday_weight=args.weekday_weight)
+    lowrank = compress(od, args.rank, args.iters)
+    lowrank.save(args.out)
+
+    print(f"Rank {args.rank} after {lowrank.iterations} iterations: "
+          f"{lowrank.stored_values()} stored values vs {lowrank.source_nnz} non-zero OD entries "
+          f"({lowrank.source_nnz * 3 / lowrank.stored_values():.1f}x smaller than COO)")
+    print("Relative reconstruction error per slice:")
+    for day in day_types2:
+        errors = lowrank.slice_errors[[_slice_index(day, hour) for hour in range(HOURS)]]
+        print(f"  {day:>3}: " + ' '.join(f"{e:.2f}" for e in errors))
+    print(f"Wrote {args.out}")
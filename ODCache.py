@@ -0,0 +1,452 @@
+# On-disk cache of the hourly OD slices and everything derived from them.
+# Every input file is hashed and recorded in a manifest together with the
+# slice it contributes to, and every derived aggregate (ALL rollup, hourly
+# marginals and changes, top-K lists) records the slice versions it was built
+# from. sync() only re-reads inputs that changed and only rebuilds aggregates
+# whose sources changed, so adding or replacing one hourly file is cheap.
+#
+# Inputs are "{day}{hour}.csv", plus optional extra days for the same slice
+# named "{day}{hour}_{tag}.csv" (e.g. W7_2025-07-30.csv); they are summed.
+# Any of them may be compressed (.csv.gz, .csv.bz2, .csv.xz, .csv.zst); a
+# plain and a compressed copy of the same input (W7.csv and W7.csv.gz) are
+# rejected rather than counted twice. Changed inputs are hashed and parsed on
+# a thread pool.
+#
+# Viewers sync the cache as they start, so several processes may sync at
+# once: sync() (and the shared export) run under a lock file in the cache
+# folder, re-read the manifests once they hold it, and every file is written
+# through a temp name unique to the process and renamed into place.
+#
+# Usage: python ODCache.py [data_dir] [--cache-dir od_cache] [--file W7.csv ...] [--remove W7.csv ...]
+#        [--workers 8]
+
+import argparse
+import hashlib
+import json
+import os
+import re
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+import numpy as np
+import scipy.sparse as sp
+try:
+    import fcntl
+except ImportError:   # Windows
+    fcntl = None
+    import msvcrt
+from Grid import load_grid
+from Instrument import phase, timed
+from ODData import (day_types, day_types2, HOURS, DENSE_FILL_RATIO, INGEST_WORKERS, DenseOD, SparseOD,
+                    as_count, check_single_copy, choose_backend, format_ingest_stats, parse_od_csv, slice_from_entries)
+
+CACHE_DIR = 'od_cache'
+LOCK_NAME = 'lock'
+TOP_CACHE_SIZE = 100
+# Bumped when the derived files change layout; older derived folders are rebuilt
+DERIVED_FORMAT = 2
+
+input_pattern = re.compile(r'^(W|SAT|SUN)(\d{1,2})(?:_[^.]+)?\.csv(?:\.(?:gz|bz2|xz|zst))?$')
+
+
+def slice_key(day, hour):
+    return f"{day}{hour}"
+
+
+def parse_input_name(filename):
+    match = input_pattern.match(os.path.basename(filename))
+    if not match or int(match.group(2)) >= HOURS:
+        return None
+    return match.group(1), int(match.group(2))
+
+
+def file_sha1(path):
+    digest = hashlib.sha1()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(1 << 20), b''):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+# Temp name next to `path`, unique to this process so concurrent writers never share one
+def _tmp_path(path, suffix=''):
+    return f"{path}.tmp{os.getpid()}{suffix}"
+
+
+def _write_json(path, data):
+    tmp = _tmp_path(path)
+    with open(tmp, 'w') as f:
+        json.dump(data, f, indent=1)
+    os.replace(tmp, path)
+
+
+def _save_matrix(path, m):
+    tmp = _tmp_path(path, '.npz')
+    sp.save_npz(tmp, sp.csr_matrix(m))
+    os.replace(tmp, path)
+
+
+def _save_arrays(path, **arrays):
+    tmp = _tmp_path(path, '.npz')
+    np.savez(tmp, **arrays)
+    os.replace(tmp, path)
+
+
+def _lock_file(f):
+    if fcntl:
+        fcntl.flock(f, fcntl.LOCK_EX)
+        return
+    f.seek(0)
+    while True:
+        try:
+            msvcrt.locking(f.fileno(), msvcrt.LK_LOCK, 1)
+            return
+        except OSError:
+            continue   # LK_LOCK gives up after 10 s; keep waiting
+
+
+def _unlock_file(f):
+    if fcntl:
+        fcntl.flock(f, fcntl.LOCK_UN)
+    else:
+        f.seek(0)
+        msvcrt.locking(f.fileno(), msvcrt.LK_UNLCK, 1)
+
+
+# lock file path -> [thread lock, open lock file, depth] for the locks this process holds
+_held = {}
+
+
+# Exclusive lock on a cache folder across processes. Re-entrant within a
+# process, so open_shared() can hold it over sync() and the export.
+@contextmanager
+def cache_lock(cache_dir=CACHE_DIR):
+    os.makedirs(cache_dir, exist_ok=True)
+    path = os.path.abspath(os.path.join(cache_dir, LOCK_NAME))
+    entry = _held.setdefault(path, [threading.RLock(), None, 0])
+    with entry[0]:
+        if entry[2] == 0:
+            entry[1] = open(path, 'a+b')
+            _lock_file(entry[1])
+        entry[2] += 1
+        try:
+            yield
+        finally:
+            entry[2] -= 1
+            if entry[2] == 0:
+                _unlock_file(entry[1])
+                entry[1].close()
+                entry[1] = None
+
+
+# Full ranking as argsort indices, largest first (ties keep index order)
+def _rank(values):
+    return np.argsort(-values, kind='stable').astype(np.int32)
+
+
+def _top_list(labels, values, order, k, pairs=None):
+    order = order[:k]
+    if pairs is None:
+        return [[int(labels[i]), float(values[i])] for i in order]
+    origins, dests = pairs
+    return [[int(labels[origins[i]]), int(labels[dests[i]]), float(values[i])] for i in order]
+
+
+class ODCache:
+    def __init__(self, cache_dir=CACHE_DIR, data_dir='.', geo_path="MAP.json", weekday_weight=1.0):
+        self.cache_dir = cache_dir
+        self.data_dir = data_dir
+        self.grid = load_grid(geo_path)
+        self.weekday_weight = weekday_weight
+        # ALL rollups depend on the weekday weight, so each weight gets its own derived folder
+        self.derived_dir = os.path.join(cache_dir, f"derived_w{weekday_weight:.6g}")
+        for sub in ('inputs', 'slices'):
+            os.makedirs(os.path.join(cache_dir, sub), exist_ok=True)
+        os.makedirs(self.derived_dir, exist_ok=True)
+        self.manifest_path = os.path.join(cache_dir, 'manifest.json')
+        self.derived_manifest_path = os.path.join(self.derived_dir, 'manifest.json')
+        self._load_manifests()
+
+    # (Re)read the manifests; loaded slices are dropped, another process may have rewritten them
+    def _load_manifests(self):
+        self.manifest = self._read_manifest(self.manifest_path, {'inputs': {}, 'slices': {}})
+        self.derived = self._read_manifest(self.derived_manifest_path, {'aggregates': {}})
+        if self.derived.get('format') != DERIVED_FORMAT:
+            self.derived = {'format': DERIVED_FORMAT, 'aggregates': {}}
+        self._slices = {}
+
+    def _read_manifest(self, path, default):
+        if os.path.exists(path):
+            with open(path, 'r') as f:
+                return json.load(f)
+        return default
+
+    def _path(self, *parts):
+        return os.path.join(self.cache_dir, *parts)
+
+    # ---- inputs and slices ----
+
+    def _slice_matrix(self, day, hour):
+        key = slice_key(day, hour)
+        if key not in self._slices:
+            path = self._path('slices', key + '.npz')
+            if os.path.exists(path):
+                self._slices[key] = sp.load_npz(path).tocsr()
+            else:
+                n = self.grid.n_regions
+                self._slices[key] = sp.csr_matrix((n, n))
+        return self._slices[key]
+
+    def _slice_version(self, day, hour):
+        return self.manifest['slices'].get(slice_key(day, hour), {}).get('version', '')
+
+    def _set_slice(self, day, hour, m, inputs):
+        key = slice_key(day, hour)
+        m = sp.csr_matrix(m)
+        m.eliminate_zeros()
+        _save_matrix(self._path('slices', key + '.npz'), m)
+        self._slices[key] = m
+        hashes = sorted(self.manifest['inputs'][name]['sha1'] for name in inputs)
+        self.manifest['slices'][key] = {
+            'inputs': sorted(inputs),
+            'version': hashlib.sha1(''.join(hashes).encode()).hexdigest(),
+        }
+
+    # Stat, hash and (if its content changed) parse one input. Touches no cache
+    # state, so sync() runs it for many files at once; returns (stat, sha1, parsed)
+    # with stat None for a missing file and parsed None for unchanged content
+    def _read_input(self, path):
+        if not os.path.exists(path):
+            return None, None, None
+        record = self.manifest['inputs'].get(os.path.basename(path))
+        stat = os.stat(path)
+        if record and record['size'] == stat.st_size and record['mtime_ns'] == stat.st_mtime_ns:
+            return stat, record['sha1'], None
+        sha1 = file_sha1(path)
+        if record and record['sha1'] == sha1:
+            return stat, sha1, None
+        return stat, sha1, parse_od_csv(path, self.grid)
+
+    # Add, replace or (if the file is gone) remove one input; returns the slice it touched
+    def update_file(self, path, loaded=None):
+        name = os.path.basename(path)
+        parsed = parse_input_name(name)
+        if parsed is None:
+            raise ValueError(f"Unrecognized filename format: {name}")
+        day, hour = parsed
+        record = self.manifest['inputs'].get(name)
+        contribution_path = self._path('inputs', name + '.npz')
+        m = self._slice_matrix(day, hour)
+        stat, sha1, entries = loaded if loaded is not None else self._read_input(path)
+
+        if stat is None:
+            if record is None:
+                return None
+            m = m - sp.load_npz(contribution_path)
+            os.remove(contribution_path)
+            del self.manifest['inputs'][name]
+        elif entries is None:
+            if record:
+                record['size'], record['mtime_ns'] = stat.st_size, stat.st_mtime_ns
+            return None
+        else:
+            if record:
+                m = m - sp.load_npz(contribution_path)
+            origins, dests, counts, stats = entries
+            contribution = slice_from_entries(origins, dests, counts, self.grid.n_regions)
+            _save_matrix(contribution_path, contribution)
+            m = m + contribution
+            self.manifest['inputs'][name] = {
+                'sha1': sha1, 'size': stat.st_size, 'mtime_ns': stat.st_mtime_ns,
+                'slice': slice_key(day, hour), 'stats': stats,
+            }
+
+        inputs = [n for n, r in self.manifest['inputs'].items() if r['slice'] == slice_key(day, hour)]
+        self._set_slice(day, hour, m, inputs)
+        return day, hour
+
+    # Path of an input named on the command line, relative to data_dir. Inputs
+    # must live in data_dir, or the next scan would treat them as deleted.
+    def input_path(self, name, exists=True):
+        path = name if os.path.isabs(name) else os.path.join(self.data_dir, name)
+        if os.path.dirname(os.path.abspath(path)) != os.path.abspath(self.data_dir):
+            raise ValueError(f"{name} is not in the data folder {self.data_dir}")
+        if parse_input_name(path) is None:
+            raise ValueError(f"Unrecognized filename format: {os.path.basename(path)}")
+        if exists and not os.path.exists(path):
+            raise FileNotFoundError(f"Input file not found: {path}")
+        if exists:
+            check_single_copy(path)
+        if not exists and os.path.exists(path):
+            raise ValueError(f"{path} still exists; delete it before removing it from the cache")
+        return path
+
+    def scan_inputs(self):
+        names = {name for name in os.listdir(self.data_dir) if parse_input_name(name)}
+        for name in names:
+            check_single_copy(os.path.join(self.data_dir, name))
+        names.update(self.manifest['inputs'])  # so deleted files are noticed
+        return sorted(os.path.join(self.data_dir, name) for name in names)
+
+    # ---- derived aggregates ----
+
+    def _sources(self, day, hour):
+        days = day_types2 if day == 'ALL' else [day]
+        return {slice_key(d, h): self._slice_version(d, h)
+                for d in days for h in (hour, (hour + 1) % HOURS)}
+
+    def _all_matrix(self, hour):
+        path = os.path.join(self.derived_dir, f"ALL{hour}.npz")
+        return sp.load_npz(path).tocsr()
+
+    @timed('aggregate')
+    def _build_all(self, hour):
+        total = self._slice_matrix('W', hour) * self.weekday_weight
+        for day in day_types2[1:]:
+            total = total + self._slice_matrix(day, hour)
+        _save_matrix(os.path.join(self.derived_dir, f"ALL{hour}.npz"), total)
+
+    @timed('aggregate')
+    def _build_hour(self, day, hour):
+        if day == 'ALL':
+            now, after = self._all_matrix(hour), self._all_matrix((hour + 1) % HOURS)
+        else:
+            now, after = self._slice_matrix(day, hour), self._slice_matrix(day, (hour + 1) % HOURS)
+        change = (now - after).tocsr()
+        labels = self.grid.labels
+
+        marginals = {}
+        for prefix, m in (('', now), ('change_', change)):
+            marginals[prefix + 'origin'] = np.asarray(m.sum(axis=1)).ravel()
+            marginals[prefix + 'destination'] = np.asarray(m.sum(axis=0)).ravel()
+            marginals[prefix + 'combined'] = marginals[prefix + 'origin'] + marginals[prefix + 'destination']
+        _save_arrays(os.path.join(self.derived_dir, f"totals_{day}{hour}.npz"), **marginals)
+
+        # Full rankings: regions for every marginal, and positions in the slice's CSR
+        # entry order for OD pairs, so any top-K is a slice of a stored array
+        ranks = {name: _rank(values) for name, values in marginals.items()}
+        coo = now.tocoo()
+        ranks['pairs'] = _rank(coo.data)
+        keep = ~self.grid.adjacent_or_same(coo.row, coo.col)
+        ranks['pairs_non_adjacent'] = np.flatnonzero(keep)[_rank(coo.data[keep])].astype(np.int32)
+        _save_arrays(os.path.join(self.derived_dir, f"rank_{day}{hour}.npz"), **ranks)
+
+        top = {name: _top_list(labels, values, ranks[name], TOP_CACHE_SIZE) for name, values in marginals.items()}
+        pairs = (coo.row, coo.col)
+        for name in ('pairs', 'pairs_non_adjacent'):
+            top[name] = _top_list(labels, coo.data, ranks[name], TOP_CACHE_SIZE, pairs)
+        _write_json(os.path.join(self.derived_dir, f"top_{day}{hour}.json"), top)
+
+    def _refresh_derived(self):
+        aggregates = self.derived['aggregates']
+        rebuilt = []
+        for hour in range(HOURS):
+            sources = {slice_key(d, hour): self._slice_version(d, hour) for d in day_types2}
+            if aggregates.get(f"ALL{hour}") != sources:
+                self._build_all(hour)
+                aggregates[f"ALL{hour}"] = sources
+                rebuilt.append(f"ALL{hour}")
+        for day in day_types:
+            for hour in range(HOURS):
+                key = f"hour_{day}{hour}"
+                sources = self._sources(day, hour)
+                if aggregates.get(key) != sources:
+                    self._build_hour(day, hour)
+                    aggregates[key] = sources
+                    rebuilt.append(key)
+        return rebuilt
+
+    def _save_manifests(self):
+        _write_json(self.manifest_path, self.manifest)
+        _write_json(self.derived_manifest_path, self.derived)
+
+    # Bring the cache up to date with the given inputs (default: everything in data_dir,
+    # where inputs that disappeared are removed). Named inputs are relative to data_dir
+    # and must exist; inputs deleted on purpose are passed as `removed`.
+    # Inputs are read and decompressed in parallel and applied in order as they finish.
+    # Runs under the cache lock; the manifests are only rewritten if something changed.
+    def sync(self, paths=None, workers=INGEST_WORKERS, removed=()):
+        with cache_lock(self.cache_dir):
+            self._load_manifests()
+            before = json.dumps([self.manifest, self.derived], sort_keys=True)
+            if paths is None and not removed:
+                paths = self.scan_inputs()
+            else:
+                paths = ([self.input_path(name) for name in paths or []]
+                         + [self.input_path(name, exists=False) for name in removed])
+            with phase('cache_sync'):
+                with ThreadPoolExecutor(max_workers=workers) as pool:
+                    loaded = pool.map(self._read_input, paths)
+                    changed = [s for s in (self.update_file(p, l) for p, l in zip(paths, loaded)) if s is not None]
+                rebuilt = self._refresh_derived()
+            if json.dumps([self.manifest, self.derived], sort_keys=True) != before:
+                self._save_manifests()
+        return changed, rebuilt
+
+    # ---- queries ----
+
+    def totals(self, day, hour):
+        with np.load(os.path.join(self.derived_dir, f"totals_{day}{hour}.npz")) as data:
+            return {name: data[name] for name in data.files}
+
+    # Full rankings for one (day, hour): region orders per marginal, CSR entry orders for pairs
+    def ranks(self, day, hour):
+        with np.load(os.path.join(self.derived_dir, f"rank_{day}{hour}.npz")) as data:
+            return {name: data[name] for name in data.files}
+
+    # Cached top-K list for one (day, hour); kind is e.g. 'origin', 'change_combined', 'pairs_non_adjacent'
+    def top(self, day, hour, kind, k):
+        if k > TOP_CACHE_SIZE:
+            raise ValueError(f"Only the top {TOP_CACHE_SIZE} entries are cached")
+        with open(os.path.join(self.derived_dir, f"top_{day}{hour}.json"), 'r') as f:
+            entries = json.load(f)[kind][:k]
+        if kind.startswith('pairs'):
+            return [((o, d), as_count(v)) for o, d, v in entries]
+        return [(r, as_count(v)) for r, v in entries]
+
+    # Backend the slices call for: 'dense' at or above the fill ratio, else 'sparse'
+    def choose_backend(self, fill_ratio=DENSE_FILL_RATIO):
+        slices = [self._slice_matrix(d, h) for d in day_types2 for h in range(HOURS)]
+        return choose_backend(slices, self.grid.n_regions, fill_ratio)
+
+    def store(self, backend='auto', fill_ratio=DENSE_FILL_RATIO):
+        slices = {(d, h): self._slice_matrix(d, h) for d in day_types2 for h in range(HOURS)}
+        if backend == 'auto':
+            backend = self.choose_backend(fill_ratio)
+        if backend not in ('dense', 'sparse'):
+            raise ValueError(f"Unknown OD backend: {backend}")
+        if backend == 'dense':
+            od = DenseOD(self.grid, {key: m.toarray() for key, m in slices.items()}, self.weekday_weight)
+            od._all = {h: self._all_matrix(h).toarray() for h in range(HOURS)}
+        else:
+            od = SparseOD(self.grid, slices, self.weekday_weight)
+            od._all = {h: self._all_matrix(h) for h in range(HOURS)}
+        return od
+
+
+# Open the cache for data_dir, bringing it up to date first
+def open_cache(data_dir='.', cache_dir=CACHE_DIR, geo_path="MAP.json", weekday_weight=1.0):
+    cache = ODCache(cache_dir, data_dir, geo_path, weekday_weight)
+    cache.sync()
+    return cache
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Incrementally update the cached OD aggregates.")
+    parser.add_argument('data_dir', nargs='?', default='.')
+    parser.add_argument('--cache-dir', default=CACHE_DIR)
+    parser.add_argument('--geo', default="MAP.json")
+    parser.add_argument('--weekday-weight', type=float, default=1.0)
+    parser.add_argument('--file', action='append', help="Only check these input files in data_dir (added or replaced)")
+    parser.add_argument('--remove', action='append', default=[], help="Drop these deleted input files from the cache")
+    parser.add_argument('--workers', type=int, default=INGEST_WORKERS, help="Input files read in parallel")
+    args = parser.parse_args()
+
+    cache = ODCache(args.cache_dir, args.data_dir, args.geo, args.weekday_weight)
+    changed, rebuilt = cache.sync(args.file, args.workers, args.remove)
+    for name, record in sorted(cache.manifest['inputs'].items()):
+        stats = record['stats']
+        if stats['malformed'] or stats['out_of_range'] or stats['duplicate']:
+            print(format_ingest_stats(name, stats))
+    print(f"Updated {len(changed)} slices: {', '.join(slice_key(d, h) for d, h in changed) or '-'}")
+    print(f"Rebuilt {len(rebuilt)} aggregates")
@@ -0,0 +1,349 @@
+# Hourly origin-destination matrices for every day type.
+# Each (day, hour) slice is held either as a dense array or as a CSR matrix;
+# choose_backend() picks one from the fill ratio of the slices (the OD cache
+# and the shared export viewers attach to both use it), so small busy grids
+# stay dense and fine grids (10k+ regions) stay sparse.
+# Both backends answer the same queries: marginals, top-K regions, top-K OD
+# pairs (optionally without adjacent pairs) and hour-over-hour changes.
+#
+# Input files may be compressed (W7.csv.gz, .bz2, .xz, or .zst with the
+# optional zstandard package); they are decompressed while being read, and
+# the OD cache reads changed files on a thread pool since decompression and
+# the C CSV parser both run outside the GIL.
+
+import bz2
+import gzip
+import io
+import lzma
+import os
+import numpy as np
+import pandas as pd
+import scipy.sparse as sp
+from Instrument import timed
+
+day_types = ['W', 'SAT', 'SUN', 'ALL']
+day_types2 = ['W', 'SAT', 'SUN']
+HOURS = 24
+
+# Use dense slices when at least this fraction of OD pairs is non-zero
+DENSE_FILL_RATIO = 0.25
+
+measures = ['origin', 'destination', 'combined']
+
+# Days of trips in one file of each day type (weekday files cover Monday-Friday)
+DAYS_PER_SLICE = {'W': 5, 'SAT': 1, 'SUN': 1}
+
+COMPRESSED_SUFFIXES = ['.gz', '.bz2', '.xz', '.zst']
+INGEST_WORKERS = min(8, os.cpu_count() or 1)
+INGEST_BLOCK_BYTES = 4 << 20
+
+
+# Plain and compressed copies of one input that exist on disk
+def input_copies(path):
+    for suffix in COMPRESSED_SUFFIXES:
+        if path.endswith(suffix):
+            path = path[:-len(suffix)]
+    return [p for p in [path] + [path + suffix for suffix in COMPRESSED_SUFFIXES] if os.path.exists(p)]
+
+
+# W7.csv next to W7.csv.gz would be counted twice, so only one copy of an input may exist
+def check_single_copy(path):
+    copies = input_copies(path)
+    if len(copies) > 1:
+        raise ValueError(f"{' and '.join(copies)} are copies of the same input; keep only one")
+    return copies
+
+
+# Hourly input file: "{day}{hour}.csv", or its compressed copy
+def od_filename(day, hour, data_dir='.'):
+    path = os.path.join(data_dir, f"{day}{hour}.csv")
+    copies = check_single_copy(path)
+    return copies[0] if copies else path
+
+
+# Binary stream of an input file, decompressed on the fly by its suffix
+def open_input(filename):
+    if filename.endswith('.gz'):
+        return gzip.open(filename, 'rb')
+    if filename.endswith('.bz2'):
+        return bz2.open(filename, 'rb')
+    if filename.endswith('.xz'):
+        return lzma.open(filename, 'rb')
+    if filename.endswith('.zst'):
+        try:
+            import zstandard
+        except ImportError:
+            raise ImportError(f"Reading {filename} needs the zstandard package (pip install zstandard)")
+        return zstandard.open(filename, 'rb')
+    return open(filename, 'rb')
+
+
+def _numbers(column):
+    return pd.to_numeric(column, errors='coerce').to_numpy(dtype=np.float64)
+
+
+# Number of set bytes in each line of a block, given the positions of its newlines
+def _per_line(ends, mask):
+    return np.diff(np.concatenate([[0], np.cumsum(mask)[ends]]))
+
+
+# Complete lines of a binary stream, about `size` bytes at a time. Any \r is
+# taken as a line end too (CRLF then leaves blank lines, which are skipped)
+def _line_blocks(stream, size=INGEST_BLOCK_BYTES):
+    rest = b''
+    while True:
+        block = stream.read(size)
+        if not block:
+            break
+        block = rest + block.replace(b'\r', b'\n')
+        cut = block.rfind(b'\n') + 1
+        rest = block[cut:]
+        if cut:
+            yield block[:cut]
+    if rest:
+        yield rest + b'\n'
+
+
+# Parse one hourly file column-wise into (origin index, destination index, count)
+# arrays. Rows are validated by mask instead of per-row try/except, and the
+# returned stats say how many rows were dropped and why:
+#   malformed     - not three fields, or a label/count that is not a number
+#   out_of_range  - region not in MAP.json, or a negative trip count
+#   duplicate     - OD pair already seen earlier in the same file (kept, summed)
+# The file is decompressed and parsed a block of lines at a time, so it is never
+# held in memory whole. Fields may be quoted ("Region 1","Region 2","3"); the C
+# parser handles the quoting and the field count is checked on what it returns
+# (empty fields after the third are ignored). Before parsing, blank lines are
+# dropped and lines with an unbalanced quote are counted as malformed, so every
+# line reaches the parser as exactly one row. Line 1 is a header when none of
+# its three fields is a number.
+@timed('ingest')
+def parse_od_csv(filename, grid):
+    origins, dests, counts = [], [], []
+    n_rows = malformed = 0
+    header = None
+    with open_input(filename) as f:
+        for block in _line_blocks(f):
+            buf = np.frombuffer(block, dtype=np.uint8)
+            ends = np.flatnonzero(buf == ord('\n'))
+            starts = np.concatenate([[0], ends[:-1] + 1])
+
+            present = _per_line(ends, buf > ord(' ')) > 0
+            good = present & (_per_line(ends, buf == ord('"')) % 2 == 0)
+            n_rows += int(present.sum())
+            malformed += int((present & ~good).sum())
+            if header is None and present.any() and not good[np.argmax(present)]:
+                header = 0
+            if not good.any():
+                continue
+
+            # Quoted commas only lower the field count, so this many columns fit every row
+            width = max(3, int(_per_line(ends, buf == ord(','))[good].max()) + 1)
+            lines = buf[np.repeat(good, ends - starts + 1)].tobytes()
+            frame = pd.read_csv(io.BytesIO(lines), header=None, names=range(width), index_col=False,
+                                dtype=str, keep_default_na=False, skip_blank_lines=False, engine='c')
+            if len(frame) != good.sum():
+                raise ValueError(f"{filename}: parsed {len(frame)} rows from {int(good.sum())} lines")
+            origin = _numbers(frame[0].str.replace('Region ', '', regex=False))
+            dest = _numbers(frame[1].str.replace('Region ', '', regex=False))
+            trips = _numbers(frame[2])
+
+            valid = np.isfinite(origin) & np.isfinite(dest) & np.isfinite(trips)
+            valid &= (origin == np.floor(origin)) & (dest == np.floor(dest))
+            three_fields = frame[2].to_numpy() != ''
+            for column in range(3, width):
+                three_fields &= frame[column].to_numpy() == ''
+            valid &= three_fields
+            if header is None:
+                header = int(three_fields[0] and np.isnan(origin[0]) and np.isnan(dest[0]) and np.isnan(trips[0]))
+            malformed += int((~valid).sum())
+            origins.append(origin[valid])
+            dests.append(dest[valid])
+            counts.append(trips[valid])
+    header = header or 0
+    malformed -= header
+
+    origin = np.concatenate(origins or [np.empty(0)]).astype(np.int64)
+    dest = np.concatenate(dests or [np.empty(0)]).astype(np.int64)
+    trips = np.trunc(np.concatenate(counts or [np.empty(0)]))
+
+    # Precomputed label -> index lookup; anything outside it is out of range
+    lookup = grid.label_to_index
+    in_lookup = (origin >= 0) & (origin < len(lookup)) & (dest >= 0) & (dest < len(lookup))
+    origin_idx = np.where(in_lookup, lookup[np.where(in_lookup, origin, 0)], -1)
+    dest_idx = np.where(in_lookup, lookup[np.where(in_lookup, dest, 0)], -1)
+    keep = (origin_idx >= 0) & (dest_idx >= 0) & (trips >= 0)
+    out_of_range = int((~keep).sum())
+    origin_idx, dest_idx, trips = origin_idx[keep], dest_idx[keep], trips[keep]
+
+    pair_keys = origin_idx * grid.n_regions + dest_idx
+    duplicate = len(pair_keys) - len(np.unique(pair_keys))
+
+    stats = {
+        'rows': n_rows - header,
+        'header': header,
+        'kept': int(len(trips)),
+        'malformed': malformed,
+        'out_of_range': out_of_range,
+        'duplicate': int(duplicate),
+        'trips': float(trips.sum()),
+    }
+    return origin_idx, dest_idx, trips, stats
+
+
+def format_ingest_stats(filename, stats):
+    return (f"{os.path.basename(filename)}: {stats['kept']} of {stats['rows']} rows kept, "
+            f"{stats['malformed']} malformed, {stats['out_of_range']} out of range, "
+            f"{stats['duplicate']} duplicate")
+
+
+# Largest k values, in descending order
+def top_indices(values, k):
+    k = min(k, len(values))
+    if k <= 0:
+        return np.empty(0, dtype=np.int64)
+    if k < len(values):
+        part = np.argpartition(-values, k - 1)[:k]
+    else:
+        part = np.arange(len(values))
+    return part[np.argsort(-values[part], kind='stable')]
+
+
+def as_count(value):
+    value = float(value)
+    return int(value) if value.is_integer() else value
+
+
+class ODStore:
+    backend = None
+
+    def __init__(self, grid, slices, weekday_weight=1.0):
+        self.grid = grid
+        self.slices = slices              # {(day, hour): matrix} for W, SAT and SUN
+        self.weekday_weight = weekday_weight
+        self._all = {}                    # ALL rollup, built on first use
+        self.ingest_stats = {}            # {filename: parse_od_csv stats}
+
+    @property
+    def n_regions(self):
+        return self.grid.n_regions
+
+    def matrix(self, day, hour):
+        if day != 'ALL':
+            return self.slices[(day, hour)]
+        if hour not in self._all:
+            total = self.slices[('W', hour)] * self.weekday_weight
+            for other in day_types2[1:]:
+                total = total + self.slices[(other, hour)]
+            self._all[hour] = total
+        return self._all[hour]
+
+    # Change between this hour and the next, same sign convention as Change.py
+    def delta(self, day, hour):
+        return self.matrix(day, hour) - self.matrix(day, (hour + 1) % HOURS)
+
+    def _slice(self, day, hour, change):
+        return self.delta(day, hour) if change else self.matrix(day, hour)
+
+    def origin_totals(self, day, hour, change=False):
+        return self._row_sums(self._slice(day, hour, change))
+
+    def destination_totals(self, day, hour, change=False):
+        return self._col_sums(self._slice(day, hour, change))
+
+    def totals(self, day, hour, measure='origin', change=False):
+        if measure == 'origin':
+            return self.origin_totals(day, hour, change)
+        if measure == 'destination':
+            return self.destination_totals(day, hour, change)
+        if measure == 'combined':
+            return self.origin_totals(day, hour, change) + self.destination_totals(day, hour, change)
+        raise ValueError(f"Unknown measure: {measure}")
+
+    def trip_total(self, day, hour):
+        return float(self._row_sums(self.matrix(day, hour)).sum())
+
+    # Top-K regions as [(region number, trips)], like the per-script heapq.nlargest lists
+    def top_regions(self, day, hour, k, measure='origin', change=False):
+        values = self.totals(day, hour, measure, change)
+        return [(int(self.grid.labels[i]), as_count(values[i])) for i in top_indices(values, k)]
+
+    # Top destinations of one origin region, or with direction='origins' the top
+    # origins of one destination region, as [(region number, trips)]
+    def top_links(self, day, hour, region_idx, k, direction='destinations', change=False):
+        m = self._slice(day, hour, change)
+        if direction == 'destinations':
+            values = self._row(m, region_idx)
+        elif direction == 'origins':
+            values = self._col(m, region_idx)
+        else:
+            raise ValueError(f"Unknown direction: {direction}")
+        return [(int(self.grid.labels[i]), as_count(values[i])) for i in top_indices(values, k) if values[i] != 0]
+
+    # Non-zero entries of a slice as (origin index, destination index, trips)
+    def entries(self, day, hour, non_adjacent=False, change=False):
+        origins, dests, values = self._entries(self._slice(day, hour, change))
+        if non_adjacent:
+            keep = ~self.grid.adjacent_or_same(origins, dests)
+            origins, dests, values = origins[keep], dests[keep], values[keep]
+        return origins, dests, values
+
+    # Top-K OD pairs as [((origin number, destination number), trips)]
+    def top_pairs(self, day, hour, k, non_adjacent=False, change=False):
+        origins, dests, values = self.entries(day, hour, non_adjacent, change)
+        labels = self.grid.labels
+        return [((int(labels[origins[i]]), int(labels[dests[i]])), as_count(values[i]))
+                for i in top_indices(values, k)]
+
+
+class DenseOD(ODStore):
+    backend = 'dense'
+
+    def _row_sums(self, m):
+        return m.sum(axis=1)
+
+    def _col_sums(self, m):
+        return m.sum(axis=0)
+
+    def _row(self, m, i):
+        return m[i]
+
+    def _col(self, m, i):
+        return m[:, i]
+
+    def _entries(self, m):
+        origins, dests = np.nonzero(m)
+        return origins, dests, m[origins, dests]
+
+
+class SparseOD(ODStore):
+    backend = 'sparse'
+
+    def _row_sums(self, m):
+        return np.asarray(m.sum(axis=1)).ravel()
+
+    def _col_sums(self, m):
+        return np.asarray(m.sum(axis=0)).ravel()
+
+    def _row(self, m, i):
+        return m[[i]].toarray().ravel()
+
+    def _col(self, m, i):
+        return m[:, [i]].toarray().ravel()
+
+    def _entries(self, m):
+        m = m.tocsr()
+        origins = np.repeat(np.arange(m.shape[0]), np.diff(m.indptr))
+        keep = m.data != 0
+        return origins[keep], m.indices[keep].astype(np.int64), m.data[keep]
+
+
+def slice_from_entries(origins, dests, counts, n):
+    # Duplicate OD pairs in a file are summed
+    return sp.csr_matrix((counts, (origins, dests)), shape=(n, n))
+
+
+# 'dense' when at least `fill_ratio` of all OD pairs in the slices are non-zero, else 'sparse'
+def choose_backend(slices, n, fill_ratio=DENSE_FILL_RATIO):
+    fill = sum(m.nnz for m in slices) / float(max(len(slices), 1) * n * n)
+    return 'dense' if fill >= fill_ratio else 'sparse'
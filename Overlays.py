@@ -0,0 +1,146 @@
+# BRT station and landmark overlays shared by the viewers.
+# Station and landmark coordinates are projected once, in one vectorized
+# transform per layer. OverlayLayers builds the artists once per axes (one
+# scatter per layer plus the landmark labels) and toggling a layer only
+# flips their visibility, so nothing else has to be re-rendered.
+
+import numpy as np
+from pyproj import Transformer
+
+
+# BRT station coordinates (WGS84)
+brt_stations = [
+    {"id": "brt_1", "lat": 42.314139, "lon": -71.791083},
+    {"id": "brt_2", "lat": 42.301139, "lon": -71.801972},
+    {"id": "brt_3", "lat": 42.276472, "lon": -71.801556},
+    {"id": "brt_4", "lat": 42.271686, "lon": -71.800596},
+    {"id": "brt_5", "lat": 42.264190, "lon": -71.795404},
+    {"id": "brt_6", "lat": 42.255527, "lon": -71.797340},
+    {"id": "brt_7", "lat": 42.241968, "lon": -71.801111},
+    {"id": "brt_8", "lat": 42.232811, "lon": -71.793633},
+    {"id": "brt_9", "lat": 42.268892, "lon": -71.842723},
+    {"id": "brt_10", "lat": 42.262146, "lon": -71.822375},
+    {"id": "brt_11", "lat": 42.248583, "lon": -71.829806},
+    {"id": "brt_12", "lat": 42.265997, "lon": -71.785728},
+    {"id": "brt_13", "lat": 42.276670, "lon": -71.763703}
+]
+brt_ids = [x['id'] for x in brt_stations]
+# Worcester landmarks data
+worcester_landmarks = {
+    'schools': [
+        {'name': 'Worcester Polytechnic Institute (WPI)', 'lat': 42.2746, 'lon': -71.8063, 'type': 'university'},
+        {'name': 'Clark University', 'lat': 42.2507, 'lon': -71.8229, 'type': 'university'},
+        {'name': 'College of the Holy Cross', 'lat': 42.3378, 'lon': -71.8064, 'type': 'university'},
+        {'name': 'UMass Medical School', 'lat': 42.2733, 'lon': -71.7622, 'type': 'university'},
+        {'name': 'Worcester State University', 'lat': 42.2669, 'lon': -71.8644, 'type': 'university'},
+        {'name': 'Assumption University', 'lat': 42.2584, 'lon': -71.8483, 'type': 'university'},
+        {'name': 'Quinsigamond Community College', 'lat': 42.2583, 'lon': -71.8230, 'type': 'college'},
+        {'name': 'Worcester Academy', 'lat': 42.2625, 'lon': -71.8028, 'type': 'high_school'},
+        {'name': 'Bancroft School', 'lat': 42.2792, 'lon': -71.8222, 'type': 'high_school'},
+        {'name': 'Worcester Technical High School', 'lat': 42.2750, 'lon': -71.8400, 'type': 'high_school'},
+    ],
+    
+    'employment': [
+        {'name': 'UMass Memorial Medical Center', 'lat': 42.2733, 'lon': -71.7622, 'type': 'hospital'},
+        {'name': 'Saint Vincent Hospital', 'lat': 42.2681, 'lon': -71.7975, 'type': 'hospital'},
+        {'name': 'The Hanover Insurance Group', 'lat': 42.2625, 'lon': -71.8028, 'type': 'corporate'},
+        {'name': 'Polar Beverages', 'lat': 42.2750, 'lon': -71.8300, 'type': 'corporate'},
+        {'name': 'Fallon Health', 'lat': 42.2650, 'lon': -71.8100, 'type': 'corporate'},
+        {'name': 'Reliant Medical Group', 'lat': 42.2700, 'lon': -71.8200, 'type': 'medical'},
+        {'name': 'Worcester Recovery Center', 'lat': 42.2600, 'lon': -71.8000, 'type': 'hospital'},
+        {'name': 'Allegro MicroSystems', 'lat': 42.2800, 'lon': -71.8100, 'type': 'corporate'},
+        {'name': 'Saint-Gobain', 'lat': 42.2900, 'lon': -71.8200, 'type': 'corporate'},
+        {'name': 'Family Health Center', 'lat': 42.2550, 'lon': -71.8150, 'type': 'medical'},
+    ],
+    
+    'commercial': [
+        {'name': 'CitySquare/Mercantile Center', 'lat': 42.2625, 'lon': -71.8028, 'type': 'shopping'},
+        {'name': 'Downtown Worcester', 'lat': 42.2626, 'lon': -71.8023, 'type': 'shopping'},
+        {'name': 'Worcester Public Market', 'lat': 42.2600, 'lon': -71.8050, 'type': 'shopping'},
+        #{'name': 'The Shops at Blackstone Valley', 'lat': 42.1333, 'lon': -71.6167, 'type': 'shopping'},
+        {'name': 'Greendale Mall Area', 'lat': 42.2333, 'lon': -71.8667, 'type': 'shopping'},
+        {'name': 'Midtown Mall', 'lat': 42.2620, 'lon': -71.8020, 'type': 'shopping'},
+        {'name': 'Lincoln Plaza', 'lat': 42.2700, 'lon': -71.8300, 'type': 'shopping'},
+        {'name': 'Park Avenue Shopping', 'lat': 42.2800, 'lon': -71.8400, 'type': 'shopping'},
+    ]
+}
+
+# Define color and marker mapping for different landmark types
+landmark_style_map = {
+    'university': {'color': 'purple', 'marker': 'U'},
+    'college': {'color': 'purple', 'marker': 'C'},
+    'high_school': {'color': 'blue', 'marker': 'H'},
+    'hospital': {'color': 'red', 'marker': 'H'},
+    'corporate': {'color': 'darkgreen', 'marker': 'C'},
+    'medical': {'color': 'pink', 'marker': 'M'},
+    'shopping': {'color': 'orange', 'marker': 'S'}
+}
+
+# Flatten landmarks into a single list
+landmark_data = []
+for category, landmarks in worcester_landmarks.items():
+    for landmark in landmarks:
+        landmark_type = landmark['type']
+        if landmark_type in landmark_style_map:
+            landmark_data.append({
+                'name': landmark['name'],
+                'lat': landmark['lat'],
+                'lon': landmark['lon'],
+                'type': landmark_type,
+                'category': category,
+                'color': landmark_style_map[landmark_type]['color'],
+                'marker': landmark_style_map[landmark_type]['marker']
+            })
+
+
+# Transform all station and landmark coordinates to map projection (EPSG:3857) at once
+transformer = Transformer.from_crs("epsg:4326", "epsg:3857", always_xy=True)
+
+
+def project_lonlat(points):
+    lons = np.array([p['lon'] for p in points])
+    lats = np.array([p['lat'] for p in points])
+    return np.column_stack(transformer.transform(lons, lats))
+
+
+brt_xy = project_lonlat(brt_stations)
+landmark_xy = project_lonlat(landmark_data)
+
+
+class OverlayLayers:
+    def __init__(self, axes, visible=None):
+        visible = visible or {}
+        self.visible = {'brt': visible.get('brt', False), 'landmarks': visible.get('landmarks', False)}
+        self.artists = {}   # ax -> {layer: [artists]}
+        for ax in axes:
+            self.artists[ax] = self._build(ax)
+            self.attach(ax)
+
+    def _build(self, ax):
+        brt = ax.scatter(brt_xy[:, 0], brt_xy[:, 1], c='deepskyblue', s=80, marker='o', edgecolor='black',
+                         zorder=10, label='BRT Station')
+        points = ax.scatter(landmark_xy[:, 0], landmark_xy[:, 1], c=[l['color'] for l in landmark_data], s=100,
+                            marker='o', edgecolor='black', zorder=11)
+        labels = [ax.text(x, y, landmark['name'], fontsize=3.5, color='white', ha='center', va='center',
+                          weight='bold', zorder=12, bbox=dict(facecolor='black', alpha=0.7, edgecolor='none', pad=1))
+                  for landmark, (x, y) in zip(landmark_data, landmark_xy)]
+        return {'brt': [brt], 'landmarks': [points] + labels}
+
+    # Re-add this axes' overlay artists after ax.cla(); they are not rebuilt
+    def attach(self, ax):
+        for layer, artists in self.artists[ax].items():
+            for artist in artists:
+                if artist.axes is None:
+                    if hasattr(artist, 'get_offsets'):
+                        ax.add_collection(artist, autolim=False)
+                    else:
+                        ax.add_artist(artist)
+                artist.set_visible(self.visible[layer])
+
+    def toggle(self, layer):
+        self.visible[layer] = not self.visible[layer]
+        for layers in self.artists.values():
+            for artist in layers[layer]:
+                artist.set_visible(self.visible[layer])
+        for ax in self.artists:
+            ax.figure.canvas.draw_idle()
@@ -1,5 +1,6 @@
 import os
-import csv
+from Grid import load_grid
+from ODData import od_filename, parse_od_csv
 
 # Function to convert file name to a nice string
 def pretty_filename(filename):
@@ -16,27 +17,23 @@ def pretty_filename(filename):
         return filename  # fallback
     return f"{day} {hour:02d}:00"
 
-# List all relevant CSV files
+# List all relevant CSV files (compressed copies are used when the .csv is missing)
 file_prefixes = ['W', 'SAT', 'SUN']
 file_list = []
 for prefix in file_prefixes:
     for i in range(24):
-        file_list.append(f"{prefix}{i}.csv")
+        file_list.append(os.path.basename(od_filename(prefix, i)))
 
+grid = load_grid("MAP.json")
 trip_counts = {}
+left_out = {}
 
+# Totals only count trips between MAP.json regions; rows naming any other
+# region (out of range) are left out and reported next to the file
 for filename in file_list:
-    total_trips = 0
-    with open(filename, 'r') as f:
-        reader = csv.reader(f)
-        for row in reader:
-            # If the first column is a label, skip it
-            # Try to sum all numeric values in the row
-            for value in row:
-                try:
-                    total_trips += int(value)
-                except ValueError:
-                    continue  # skip non-numeric values (e.g., headers or labels)
+    origins, destinations, counts, stats = parse_od_csv(filename, grid)
+    total_trips = int(counts.sum())
+    left_out[filename] = stats['out_of_range']
     # If file starts with 'W', divide total_trips by 5
     if filename.startswith('W'):
         total_trips = total_trips // 5  # Use integer division for consistency
@@ -45,9 +42,10 @@ for filename in file_list:
 # Sort files by total trips, descending
 sorted_files = sorted(trip_counts.items(), key=lambda x: x[1], reverse=True)
 
-print("Order of files by total trips (most to least):")
+print("Order of files by total trips between MAP.json regions (most to least):")
 for fname, count in sorted_files:
-    print(f"{pretty_filename(fname)}: {count} trips")
+    note = f" ({left_out[fname]} rows outside MAP.json left out)" if left_out[fname] else ""
+    print(f"{pretty_filename(fname)}: {count} trips{note}")
 
 
 
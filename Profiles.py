@@ -0,0 +1,162 @@
+# Temporal-profile similarity search between regions.
+# A region's profile is its trips in each of the 72 base slices (W, SAT and
+# SUN x 24 hours): as origin, as destination, or both side by side. Profiles
+# are normalized once (unit length for cosine, centred and unit length for
+# correlation), so the similarity of one region to every other is a single
+# matrix-vector product and a top-k selection, and clustering all regions into
+# profile types is spherical k-means on the same normalized matrix.
+#
+# Usage: python Profiles.py --like 250 [--k 10] [--metric correlation] [--measure both]
+#        python Profiles.py --like-landmark WPI
+#        python Profiles.py --clusters 8
+
+import argparse
+import numpy as np
+from ODData import day_types2, HOURS, top_indices
+from Grid import lonlat_to_mercator
+
+METRICS = ['cosine', 'correlation']
+PROFILE_MEASURES = ['origin', 'destination', 'both']
+
+
+# (n_regions, 72) trips per base slice, or (n_regions, 144) for 'both'
+def region_profiles(od, measure='both'):
+    if measure == 'both':
+        return np.hstack([region_profiles(od, 'origin'), region_profiles(od, 'destination')])
+    columns = [od.totals(day, hour, measure) for day in day_types2 for hour in range(HOURS)]
+    return np.column_stack(columns).astype(np.float64)
+
+
+def normalize_profiles(profiles, metric='cosine'):
+    if metric not in METRICS:
+        raise ValueError(f"Unknown metric: {metric}")
+    profiles = np.asarray(profiles, dtype=np.float64)
+    if metric == 'correlation':
+        profiles = profiles - profiles.mean(axis=1, keepdims=True)
+    norms = np.linalg.norm(profiles, axis=1, keepdims=True)
+    # Regions without any trips (or a flat profile, for correlation) stay all-zero
+    return np.divide(profiles, norms, out=np.zeros_like(profiles), where=norms > 0)
+
+
+class ProfileIndex:
+    def __init__(self, grid, profiles, metric='cosine'):
+        self.grid = grid
+        self.metric = metric
+        self.profiles = profiles
+        self.unit = normalize_profiles(profiles, metric)
+        self.active = np.linalg.norm(self.unit, axis=1) > 0
+
+    # Similarity of every region to each query index, shape (len(indices), n)
+    def similarities(self, indices):
+        return self.unit[np.atleast_1d(indices)] @ self.unit.T
+
+    # Top-k most similar regions to one region number, as [(region number, similarity)]
+    def neighbours(self, region, k=10):
+        idx = self.grid.index_of(region)
+        if idx < 0:
+            raise KeyError(f"Unknown region: {region}")
+        scores = self.similarities(idx)[0]
+        scores[idx] = -np.inf
+        scores[~self.active] = -np.inf
+        return [(int(self.grid.labels[i]), float(scores[i])) for i in top_indices(scores, k) if np.isfinite(scores[i])]
+
+    # Top-k neighbours for many regions at once: (indices, similarities), both (len(regions), k),
+    # with k capped at the n - 1 other regions
+    def neighbours_batch(self, indices, k=10):
+        indices = np.atleast_1d(indices)
+        scores = self.similarities(indices)
+        k = max(min(k, scores.shape[1] - 1), 0)
+        scores[np.arange(len(indices)), indices] = -np.inf
+        scores[:, ~self.active] = -np.inf
+        part = np.argpartition(-scores, k - 1, axis=1)[:, :k]
+        order = np.argsort(-np.take_along_axis(scores, part, axis=1), axis=1, kind='stable')
+        best = np.take_along_axis(part, order, axis=1)
+        return best, np.take_along_axis(scores, best, axis=1)
+
+    # Spherical k-means over the active regions; returns (cluster per region, -1
+    # for regions without trips, and the unit-length cluster centres)
+    def cluster(self, n_clusters=8, iters=50, seed=0):
+        rng = np.random.default_rng(seed)
+        points = self.unit[self.active]
+        n_clusters = min(n_clusters, len(points))
+        # k-means++ style seeding on cosine distance
+        centres = [points[rng.integers(len(points))]]
+        for _ in range(1, n_clusters):
+            distance = 1 - np.max(points @ np.array(centres).T, axis=1)
+            distance = np.maximum(distance, 0)
+            total = distance.sum()
+            probabilities = distance / total if total > 0 else None
+            centres.append(points[rng.choice(len(points), p=probabilities)])
+        centres = np.array(centres)
+
+        assignment = None
+        for _ in range(iters):
+            new_assignment = np.argmax(points @ centres.T, axis=1)
+            if assignment is not None and np.array_equal(new_assignment, assignment):
+                break
+            assignment = new_assignment
+            sums = np.zeros_like(centres)
+            np.add.at(sums, assignment, points)
+            norms = np.linalg.norm(sums, axis=1, keepdims=True)
+            empty = norms[:, 0] == 0
+            centres = np.where(empty[:, None], centres, sums / np.where(norms > 0, norms, 1))
+
+        labels = np.full(self.grid.n_regions, -1, dtype=np.int64)
+        labels[self.active] = assignment
+        return labels, centres
+
+
+def build_profile_index(od, measure='both', metric='cosine'):
+    return ProfileIndex(od.grid, region_profiles(od, measure), metric)
+
+
+# Region number under a landmark whose name contains `name` (case-insensitive)
+def landmark_region(grid, name):
+    from Overlays import worcester_landmarks
+    for group in worcester_landmarks.values():
+        for landmark in group:
+            if name.lower() in landmark['name'].lower():
+                idx = grid.region_at(*lonlat_to_mercator(landmark['lon'], landmark['lat']))
+                if idx < 0:
+                    raise KeyError(f"{landmark['name']} is outside the region grid")
+                return int(grid.labels[idx]), landmark['name']
+    raise KeyError(f"No landmark matching {name!r}")
+
+
+def _peak_hours(profile):
+    # Busiest hour per day type of a (72,) or (144,) profile
+    per_day = profile[:len(day_types2) * HOURS].reshape(len(day_types2), HOURS)
+    return ', '.join(f"{day} {int(np.argmax(row)):02d}:00" for day, row in zip(day_types2, per_day))
+
+
+if __name__ == '__main__':
+    from SharedOD import open_shared
+
+    parser = argparse.ArgumentParser(description="Find regions with similar hourly activity, or cluster them.")
+    parser.add_argument('--like', type=int, default=None, metavar='REGION')
+    parser.add_argument('--like-landmark', default=None, metavar='NAME')
+    parser.add_argument('--k', type=int, default=10)
+    parser.add_argument('--clusters', type=int, default=None)
+    parser.add_argument('--metric', choices=METRICS, default='cosine')
+    parser.add_argument('--measure', choices=PROFILE_MEASURES, default='both')
+    args = parser.parse_args()
+
+    od = open_shared()
+    index = build_profile_index(od, args.measure, args.metric)
+
+    region = args.like
+    if args.like_landmark:
+        region, name = landmark_region(od.grid, args.like_landmark)
+        print(f"{name} is in Region {region}")
+    if region is not None:
+        print(f"Regions most like Region {region} ({args.metric}, {args.measure}):")
+        for other, score in index.neighbours(region, args.k):
+            print(f"  Region {other}: {score:.3f}")
+
+    if args.clusters:
+        labels, centres = index.cluster(args.clusters)
+        for c in range(len(centres)):
+            members = od.grid.labels[labels == c]
+            print(f"Type {c + 1}: {len(members)} regions, peaks {_peak_hours(centres[c])}; "
+                  f"e.g. {', '.join(str(m) for m in members[:8])}")
+        print(f"{int((labels < 0).sum())} regions without trips")
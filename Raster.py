@@ -0,0 +1,51 @@
+# Raster heatmaps on the regular region grid.
+# Each region is a (row, col) cell of the MAP.json grid, so per-region values
+# can be scattered into a 2D array and drawn with a single imshow call
+# instead of one polygon per region. Optional k-ring smoothing averages each
+# cell with the (2k+1) x (2k+1) block of cells around it, using summed-area
+# tables so the cost does not depend on k.
+
+import numpy as np
+from Grid import lonlat_to_mercator
+
+
+# Per-region values -> (n_rows, n_cols) array, NaN where there is no region
+def region_raster(grid, values):
+    raster = np.full((grid.n_rows, grid.n_cols), np.nan)
+    raster[grid.rows, grid.cols] = values
+    return raster
+
+
+# (left, right, bottom, top) of the grid in EPSG:3857, for imshow(extent=...).
+# Mercator stretches rows slightly towards the north; over the ~15 km span of
+# the city the drift is a few metres, well below one cell.
+def raster_extent_3857(grid):
+    left, bottom = lonlat_to_mercator(grid.lon0, grid.lat0)
+    right, top = lonlat_to_mercator(grid.lon0 + grid.n_cols * grid.dlon, grid.lat0 + grid.n_rows * grid.dlat)
+    return float(left), float(right), float(bottom), float(top)
+
+
+def _box_sum(a, k):
+    # Sum over the (2k+1) x (2k+1) block around every cell, clipped at the edges
+    padded = np.pad(a, ((k + 1, k), (k + 1, k)))
+    table = padded.cumsum(axis=0).cumsum(axis=1)
+    size = 2 * k + 1
+    return (table[size:, size:] - table[:-size, size:] - table[size:, :-size] + table[:-size, :-size])
+
+
+# Mean of every k-ring neighbourhood, counting only cells that are regions
+def smooth_k_ring(raster, k):
+    if k <= 0:
+        return raster
+    present = ~np.isnan(raster)
+    sums = _box_sum(np.where(present, raster, 0.0), k)
+    counts = _box_sum(present.astype(np.float64), k)
+    smoothed = np.divide(sums, counts, out=np.zeros_like(sums), where=counts > 0)
+    return np.where(present, smoothed, np.nan)
+
+
+def draw_heatmap(ax, grid, values, smoothing=0, cmap='magma_r', alpha=0.75, zorder=2):
+    raster = smooth_k_ring(region_raster(grid, values), smoothing)
+    vmax = np.nanmax(raster) if np.isfinite(raster).any() else 1.0
+    return ax.imshow(raster, extent=raster_extent_3857(grid), origin='lower', cmap=cmap,
+                     vmin=0, vmax=max(vmax, 1e-9), alpha=alpha, interpolation='nearest', zorder=zorder)
@@ -1,6 +1,10 @@
-import csv
-from collections import defaultdict
+import argparse
+import os
 import re
+import numpy as np
+from Grid import load_grid
+from ODData import format_ingest_stats, od_filename, parse_od_csv, top_indices
+from HeavyHitters import SpaceSaving, pack_keys, unpack_key
 
 def pretty_filename(filename):
     if filename.startswith('W'):
@@ -16,15 +20,28 @@ def pretty_filename(filename):
         return filename, -1, ''
     return day, hour, filename
 
-# List all relevant CSV files
+# List all relevant CSV files (compressed copies are used when the .csv is missing)
 file_prefixes = ['W', 'SAT', 'SUN']
 file_list = []
 for prefix in file_prefixes:
     for i in range(24):
-        file_list.append(f"{prefix}{i}.csv")
+        file_list.append(os.path.basename(od_filename(prefix, i)))
 
-# (origin, destination, hour) -> total trips (sum across all days)
-trip_counts = defaultdict(int)
+# Optional: python Regions.py --approx CAPACITY tracks heavy hitters in fixed
+# memory (CAPACITY counters per sketch) instead of counting every key exactly
+parser = argparse.ArgumentParser()
+parser.add_argument('--approx', type=int, default=None, metavar='CAPACITY')
+args = parser.parse_args()
+
+grid = load_grid("MAP.json")
+n = grid.n_regions
+
+# (origin, destination, hour) packed into one integer key, summed across all days
+keys = []
+trips = []
+if args.approx:
+    odh_sketch = SpaceSaving(args.approx)
+    od_sketch = SpaceSaving(args.approx)
 
 for filename in file_list:
     match = re.match(r'(W|SAT|SUN)(\d+)\.csv', filename)
@@ -34,24 +51,41 @@ for filename in file_list:
         print(f"Unrecognized filename format: {filename}")
         continue
 
-    with open(filename, 'r') as f:
-        reader = csv.reader(f)
-        rows = list(reader)
-        for row in rows[1:]:  # skip header
-            try:
-                # Extract region numbers from "Region X"
-                origin = int(row[0].replace("Region ", ""))
-                destination = int(row[1].replace("Region ", ""))
-                trips = int(float(row[2].strip()))
-                #if filename.startswith('W'):
-                    #trips = trips // 5
-                trip_counts[(origin, destination, hour)] += trips
-            except Exception as e:
-                print(f"Skipping row due to error: {row} ({e})")
-                continue
-
-# Get top 100 (origin, destination, hour) by trip count
-top_100 = sorted(trip_counts.items(), key=lambda x: x[1], reverse=True)[:100]
+    origins, destinations, counts, stats = parse_od_csv(filename, grid)
+    if stats['malformed'] or stats['out_of_range']:
+        print(f"Skipping rows in {format_ingest_stats(filename, stats)}")
+    #if filename.startswith('W'):
+        #counts = counts // 5
+    if args.approx:
+        odh_sketch.update(pack_keys(origins, destinations, n, np.full(len(origins), hour)), counts)
+        od_sketch.update(pack_keys(origins, destinations, n), counts)
+        continue
+    keys.append((hour * n + origins) * n + destinations)
+    trips.append(counts)
+
+if args.approx:
+    print(f"Heavy-hitter mode: {args.approx} counters per sketch, "
+          f"counts overestimate by at most {odh_sketch.error_bound():.1f} trips")
+    print(f"Top 100 ranking is {'exact' if odh_sketch.top_is_exact(100) else 'approximate'}")
+    top_100 = []
+    for key, count, error in odh_sketch.top(100):
+        origin, destination, hour = unpack_key(key, n)
+        top_100.append(((int(grid.labels[origin]), int(grid.labels[destination]), hour), int(count)))
+
+    print("Top 100 origin-destination pairs (all hours and days combined):")
+    for key, count, error in od_sketch.top(100):
+        origin, destination, _ = unpack_key(key, n)
+        print(f"Origin {grid.labels[origin]} → Destination {grid.labels[destination]}: {int(count)} trips (± {int(error)})")
+else:
+    keys, inverse = np.unique(np.concatenate(keys), return_inverse=True)
+    totals = np.bincount(inverse, weights=np.concatenate(trips))
+
+    # Get top 100 (origin, destination, hour) by trip count
+    top_100 = []
+    for i in top_indices(totals, 100):
+        hour, rest = divmod(int(keys[i]), n * n)
+        origin, destination = divmod(rest, n)
+        top_100.append(((int(grid.labels[origin]), int(grid.labels[destination]), hour), int(totals[i])))
 
 print("Top 100 most popular origin-destination-hour combinations (all days combined):")
 for ((origin, destination, hour), count) in top_100:
@@ -0,0 +1,96 @@
+# Headless report of every ranking the viewers and scripts show, as tables.
+# One run writes, for all day types and hours:
+#   top_regions   day, hour, measure, rank, region, trips       (Combined.py)
+#   top_changes   day, hour, measure, rank, region, change      (Change.py)
+#   top_pairs     day, hour, rank, origin, destination, trips   (Arrows.py, non-adjacent pairs)
+#   slice_totals  day, hour, trips, trips_per_day               (PopularRegions.py)
+#   file_totals   one row per input file with its ingest counts
+# in any of CSV, JSON (records) and Parquet. Only the data modules are
+# imported, so it runs without matplotlib or geopandas (Parquet needs pyarrow).
+#
+# Usage: python Report.py [--out reports] [--format csv json parquet] [--top 100]
+#        [--pairs 30] [--weekday-weight 1.0]
+
+import argparse
+import os
+import pandas as pd
+from ODData import day_types, DAYS_PER_SLICE, HOURS, measures
+from ODCache import open_cache, parse_input_name
+from SharedOD import attach_shared, export_shared
+
+REPORT_DIR = 'reports'
+FORMATS = ['csv', 'json', 'parquet']
+
+
+def _ranking_rows(day, hour, measure, ranking, value_name):
+    return [{'day': day, 'hour': hour, 'measure': measure, 'rank': rank, 'region': region, value_name: value}
+            for rank, (region, value) in enumerate(ranking, start=1)]
+
+
+def ranking_tables(od, top=100, pairs=30):
+    regions, changes, od_pairs, slices = [], [], [], []
+    for day in day_types:
+        for hour in range(HOURS):
+            for measure in measures:
+                regions += _ranking_rows(day, hour, measure, od.top_regions(day, hour, top, measure), 'trips')
+                changes += _ranking_rows(day, hour, measure, od.top_regions(day, hour, top, measure, change=True),
+                                         'change')
+            for rank, ((origin, destination), trips) in enumerate(
+                    od.top_pairs(day, hour, pairs, non_adjacent=True), start=1):
+                od_pairs.append({'day': day, 'hour': hour, 'rank': rank, 'origin': origin,
+                                 'destination': destination, 'trips': trips})
+            trips = od.trip_total(day, hour)
+            per_day = trips / DAYS_PER_SLICE[day] if day in DAYS_PER_SLICE else None
+            slices.append({'day': day, 'hour': hour, 'trips': trips, 'trips_per_day': per_day})
+    return {
+        'top_regions': pd.DataFrame(regions),
+        'top_changes': pd.DataFrame(changes),
+        'top_pairs': pd.DataFrame(od_pairs),
+        'slice_totals': pd.DataFrame(slices),
+    }
+
+
+def file_table(cache):
+    rows = []
+    for name, record in sorted(cache.manifest['inputs'].items()):
+        day, hour = parse_input_name(name)
+        rows.append({'file': name, 'day': day, 'hour': hour, **record.get('stats', {})})
+    return pd.DataFrame(rows)
+
+
+def write_tables(tables, out_dir=REPORT_DIR, formats=('csv',)):
+    os.makedirs(out_dir, exist_ok=True)
+    written = []
+    for name, table in tables.items():
+        for fmt in formats:
+            path = os.path.join(out_dir, f"{name}.{fmt}")
+            if fmt == 'csv':
+                table.to_csv(path, index=False)
+            elif fmt == 'json':
+                table.to_json(path, orient='records', indent=1)
+            elif fmt == 'parquet':
+                table.to_parquet(path, index=False)
+            else:
+                raise ValueError(f"Unknown format: {fmt}")
+            written.append(path)
+    return written
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Write every ranking as CSV / JSON / Parquet tables.")
+    parser.add_argument('data_dir', nargs='?', default='.')
+    parser.add_argument('--out', default=REPORT_DIR)
+    parser.add_argument('--format', nargs='+', choices=FORMATS, default=['csv'])
+    parser.add_argument('--top', type=int, default=100, help="Regions per ranking")
+    parser.add_argument('--pairs', type=int, default=30, help="Non-adjacent OD pairs per hour")
+    parser.add_argument('--weekday-weight', type=float, default=1.0, help="Weight of weekday trips in ALL")
+    args = parser.parse_args()
+
+    cache = open_cache(args.data_dir, weekday_weight=args.weekday_weight)
+    od = attach_shared(export_shared(cache))
+    tables = ranking_tables(od, args.top, args.pairs)
+    tables['file_totals'] = file_table(cache)
+    written = write_tables(tables, args.out, args.format)
+    for name, table in tables.items():
+        print(f"{name}: {len(table)} rows")
+    print(f"Wrote {len(written)} files to {args.out}")
@@ -0,0 +1,74 @@
+# Render scheduler for the slider viewers.
+# Slider moves, day buttons and arrow keys only *request* a (day, hour) frame.
+# Requests are coalesced: a frame is rendered once input has been quiet for
+# RENDER_DELAY_MS (or at the latest MAX_WAIT_MS after the first pending
+# request, so holding an arrow key still animates), and only the newest
+# requested state is drawn. Intermediate states are dropped, and a request
+# for the frame already on screen is skipped.
+
+import sys
+import time
+import Instrument
+
+RENDER_DELAY_MS = 50
+MAX_WAIT_MS = 250
+
+
+class RenderScheduler:
+    def __init__(self, canvas, render, delay_ms=RENDER_DELAY_MS, max_wait_ms=MAX_WAIT_MS):
+        self.render = render            # called as render(*state)
+        self.delay_ms = delay_ms
+        self.max_wait_ms = max_wait_ms
+        self.pending = None             # (state, force) of the newest request
+        self.pending_since = None
+        self.current = None             # state on screen
+        self.requested = 0
+        self.rendered = 0
+        self.dropped = 0                # superseded before they were drawn
+        self.skipped = 0                # already on screen
+        self.timer = canvas.new_timer(interval=delay_ms)
+        self.timer.single_shot = True
+        self.timer.add_callback(self.flush)
+        canvas.mpl_connect('close_event', self._on_close)
+        Instrument.add_source('render_scheduler', self.stats)
+
+    # Ask for a frame; force re-renders even if this state is already shown (e.g. a mode toggle)
+    def request(self, state, force=False):
+        self.requested += 1
+        now = time.perf_counter()
+        if self.pending is not None:
+            self.dropped += 1
+            force = force or self.pending[1]
+        else:
+            self.pending_since = now
+        self.pending = (state, force)
+
+        self.timer.stop()
+        waited_ms = (now - self.pending_since) * 1000
+        self.timer.interval = max(1, min(self.delay_ms, self.max_wait_ms - waited_ms))
+        self.timer.start()
+
+    # Render the newest pending request now, if any
+    def flush(self):
+        if self.pending is None:
+            return
+        (state, force), self.pending = self.pending, None
+        if state == self.current and not force:
+            self.skipped += 1
+            return
+        self.render_now(state)
+
+    def render_now(self, state):
+        self.render(*state)
+        self.current = state
+        self.rendered += 1
+
+    def stats(self):
+        return {'requested': self.requested, 'rendered': self.rendered,
+                'dropped': self.dropped, 'skipped': self.skipped}
+
+    def _on_close(self, event):
+        if Instrument.enabled:
+            stats = self.stats()
+            print(f"[scheduler] {stats['rendered']} frames rendered for {stats['requested']} requested "
+                  f"({stats['dropped']} dropped, {stats['skipped']} already on screen)", file=sys.stderr)
@@ -0,0 +1,241 @@
+# Read-only, memory-mapped OD data shared between viewer processes.
+# export_shared() flattens the cached slices (CSR arrays for every day type
+# and hour, ALL included), their marginals and the grid geometry into plain
+# .npy files. attach_shared() maps them with np.load(mmap_mode='r'), so any
+# number of viewers or batch jobs share one copy through the OS page cache
+# and a new process only has to map the files instead of rebuilding them.
+# The full rankings (argsort of every marginal and of the pair values) are
+# exported too, so any top-K is a slice instead of a selection.
+#
+# The export follows the same dense/sparse choice as the in-memory stores:
+# when the slices are at least DENSE_FILL_RATIO full, every slice is also
+# written as one (96, n, n) array and attach_shared() returns a SharedDenseOD
+# whose slices are dense views onto it; otherwise a SharedOD over the CSR
+# arrays.
+#
+# Each export lives in a folder named after the cache state it was built
+# from, so a process never attaches to stale data; it is written to a temp
+# folder and renamed into place, so it is never seen half-written. Syncing
+# and exporting hold the cache lock, so viewers started together wait for
+# one another instead of rewriting the same files.
+
+import hashlib
+import json
+import os
+import shutil
+import numpy as np
+import scipy.sparse as sp
+from Grid import RegionGrid, cell_bounds_3857, centroids_3857
+from ODCache import CACHE_DIR, cache_lock, open_cache
+from ODData import day_types, HOURS, DENSE_FILL_RATIO, DenseOD, SparseOD, as_count
+
+SHARED_DIR = 'od_shared'
+
+total_names = ['origin', 'destination', 'combined', 'change_origin', 'change_destination', 'change_combined']
+
+
+def shared_key(cache, backend='sparse'):
+    state = json.dumps({'weekday_weight': cache.weekday_weight, 'format': cache.derived.get('format'),
+                        'aggregates': cache.derived['aggregates'], 'backend': backend}, sort_keys=True)
+    return hashlib.sha1(state.encode()).hexdigest()[:16]
+
+
+def _write_export(cache, path, backend):
+    grid = cache.grid
+    n = grid.n_regions
+    od = cache.store(backend='sparse')
+    matrices = [od.matrix(day, hour).tocsr() for day in day_types for hour in range(HOURS)]
+    if backend == 'dense':
+        # Written a slice at a time, so the export never holds every dense slice at once
+        dense = np.lib.format.open_memmap(os.path.join(path, 'dense.npy'), mode='w+', dtype=np.float64,
+                                          shape=(len(matrices), n, n))
+        for i, m in enumerate(matrices):
+            dense[i] = m.toarray()
+        dense.flush()
+        del dense
+
+    nnz = np.array([m.nnz for m in matrices], dtype=np.int64)
+    index_dtype = np.int32 if nnz.max(initial=0) < 2**31 - 1 and n < 2**31 - 1 else np.int64
+    offsets = np.concatenate([[0], np.cumsum(nnz)])
+    np.save(os.path.join(path, 'offsets.npy'), offsets)
+    np.save(os.path.join(path, 'indptr.npy'), np.stack([m.indptr.astype(index_dtype) for m in matrices]))
+    np.save(os.path.join(path, 'indices.npy'), np.concatenate([m.indices.astype(index_dtype) for m in matrices]))
+    np.save(os.path.join(path, 'data.npy'), np.concatenate([m.data.astype(np.float64) for m in matrices]))
+
+    totals = np.zeros((len(day_types), HOURS, len(total_names), n))
+    for d, day in enumerate(day_types):
+        for hour in range(HOURS):
+            hour_totals = cache.totals(day, hour)
+            totals[d, hour] = [hour_totals[name] for name in total_names]
+    np.save(os.path.join(path, 'totals.npy'), totals)
+
+    # Full rankings from the cache: region orders per marginal, and OD pair orders
+    # as positions into each slice's entries in data.npy
+    ranks = np.zeros((len(day_types), HOURS, len(total_names), n), dtype=np.int32)
+    pair_ranks, non_adjacent_ranks = [], []
+    for d, day in enumerate(day_types):
+        for hour in range(HOURS):
+            hour_ranks = cache.ranks(day, hour)
+            ranks[d, hour] = [hour_ranks[name] for name in total_names]
+            if len(hour_ranks['pairs']) != nnz[d * HOURS + hour]:
+                raise RuntimeError(f"Cached pair ranking for {day}{hour} does not match its slice")
+            pair_ranks.append(hour_ranks['pairs'])
+            non_adjacent_ranks.append(hour_ranks['pairs_non_adjacent'])
+    np.save(os.path.join(path, 'ranks.npy'), ranks)
+    np.save(os.path.join(path, 'pair_ranks.npy'), np.concatenate(pair_ranks))
+    np.save(os.path.join(path, 'non_adjacent_offsets.npy'),
+            np.concatenate([[0], np.cumsum([len(r) for r in non_adjacent_ranks])]))
+    np.save(os.path.join(path, 'non_adjacent_ranks.npy'), np.concatenate(non_adjacent_ranks))
+
+    np.save(os.path.join(path, 'labels.npy'), grid.labels)
+    np.save(os.path.join(path, 'rows.npy'), grid.rows)
+    np.save(os.path.join(path, 'cols.npy'), grid.cols)
+    np.save(os.path.join(path, 'bounds_3857.npy'), cell_bounds_3857(grid))
+    np.save(os.path.join(path, 'centroids_3857.npy'), centroids_3857(grid))
+    with open(os.path.join(path, 'meta.json'), 'w') as f:
+        json.dump({
+            'n_regions': n, 'weekday_weight': cache.weekday_weight, 'backend': backend,
+            'lon0': grid.lon0, 'lat0': grid.lat0, 'dlon': grid.dlon, 'dlat': grid.dlat,
+            'day_types': day_types, 'hours': HOURS, 'totals': total_names,
+        }, f, indent=1)
+
+
+# backend 'auto' picks dense or sparse from the fill ratio of the cached slices
+def export_shared(cache, shared_dir=SHARED_DIR, backend='auto', fill_ratio=DENSE_FILL_RATIO):
+    with cache_lock(cache.cache_dir):
+        if backend == 'auto':
+            backend = cache.choose_backend(fill_ratio)
+        if backend not in ('dense', 'sparse'):
+            raise ValueError(f"Unknown OD backend: {backend}")
+        return _export_locked(cache, shared_dir, backend)
+
+
+def _export_locked(cache, shared_dir, backend):
+    os.makedirs(shared_dir, exist_ok=True)
+    prefix = f"w{cache.weekday_weight:.6g}_{backend}_"
+    target = os.path.join(shared_dir, prefix + shared_key(cache, backend))
+    if os.path.exists(os.path.join(target, 'meta.json')):
+        return target
+
+    tmp = f"{target}.tmp{os.getpid()}"
+    os.makedirs(tmp, exist_ok=True)
+    _write_export(cache, tmp, backend)
+    try:
+        os.rename(tmp, target)
+    except OSError:
+        # Another process finished the same export first
+        shutil.rmtree(tmp, ignore_errors=True)
+
+    # Older exports for this weight and backend are no longer reachable; attached
+    # processes keep their mappings even after the files are unlinked
+    for name in os.listdir(shared_dir):
+        old = os.path.join(shared_dir, name)
+        if name.startswith(prefix) and old != target and '.tmp' not in name:
+            shutil.rmtree(old, ignore_errors=True)
+    return target
+
+
+# Attaching and the queries answered from the shared arrays, for either backend
+class _SharedStore:
+    def __init__(self, path):
+        load = lambda name: np.load(os.path.join(path, name + '.npy'), mmap_mode='r')
+        with open(os.path.join(path, 'meta.json'), 'r') as f:
+            self.meta = json.load(f)
+        self.path = path
+        self.offsets = load('offsets')
+        self.indptr = load('indptr')
+        self.indices = load('indices')
+        self.data = load('data')
+        self.shared_totals = load('totals')
+        self.ranks = load('ranks')
+        self.pair_ranks = load('pair_ranks')
+        self.non_adjacent_offsets = load('non_adjacent_offsets')
+        self.non_adjacent_ranks = load('non_adjacent_ranks')
+        self.bounds_3857 = load('bounds_3857')
+        self.centroids_3857 = load('centroids_3857')
+        grid = RegionGrid(load('labels'), load('rows'), load('cols'),
+                          self.meta['lon0'], self.meta['lat0'], self.meta['dlon'], self.meta['dlat'])
+
+        n = self.meta['n_regions']
+        self.csr = {}             # {(day, hour): CSR view}, also used for the pair rankings
+        for d, day in enumerate(day_types):
+            for hour in range(HOURS):
+                i = d * HOURS + hour
+                start, end = self.offsets[i], self.offsets[i + 1]
+                # CSR views straight onto the mapped arrays, nothing is copied
+                m = sp.csr_matrix((n, n), dtype=np.float64)
+                m.data = self.data[start:end]
+                m.indices = self.indices[start:end]
+                m.indptr = self.indptr[i]
+                self.csr[(day, hour)] = m
+        matrices = self._views(path)
+        super().__init__(grid, {key: m for key, m in matrices.items() if key[0] != 'ALL'},
+                         self.meta['weekday_weight'])
+        self._all = {hour: matrices[('ALL', hour)] for hour in range(HOURS)}
+
+    # Marginals come from the shared arrays instead of being summed again
+    def totals(self, day, hour, measure='origin', change=False):
+        name = ('change_' if change else '') + measure
+        if name not in total_names:
+            raise ValueError(f"Unknown measure: {measure}")
+        return self.shared_totals[day_types.index(day), hour, total_names.index(name)]
+
+    def origin_totals(self, day, hour, change=False):
+        return self.totals(day, hour, 'origin', change)
+
+    # Top-K by slicing the stored full rankings; any K costs O(K)
+    def top_regions(self, day, hour, k, measure='origin', change=False):
+        name = ('change_' if change else '') + measure
+        if name not in total_names:
+            raise ValueError(f"Unknown measure: {measure}")
+        d, t = day_types.index(day), total_names.index(name)
+        values = self.shared_totals[d, hour, t]
+        return [(int(self.grid.labels[i]), as_count(values[i])) for i in self.ranks[d, hour, t, :k]]
+
+    def top_pairs(self, day, hour, k, non_adjacent=False, change=False):
+        if change:
+            return super().top_pairs(day, hour, k, non_adjacent, change)
+        i = day_types.index(day) * HOURS + hour
+        if non_adjacent:
+            order = self.non_adjacent_ranks[self.non_adjacent_offsets[i]:self.non_adjacent_offsets[i + 1]][:k]
+        else:
+            order = self.pair_ranks[self.offsets[i]:self.offsets[i + 1]][:k]
+        m = self.csr[(day, hour)]
+        origins = np.searchsorted(m.indptr, order, side='right') - 1
+        labels = self.grid.labels
+        return [((int(labels[o]), int(labels[m.indices[e]])), as_count(m.data[e]))
+                for o, e in zip(origins, order) if m.data[e] != 0]
+
+    def destination_totals(self, day, hour, change=False):
+        return self.totals(day, hour, 'destination', change)
+
+
+class SharedOD(_SharedStore, SparseOD):
+    backend = 'shared'
+
+    def _views(self, path):
+        return self.csr
+
+
+class SharedDenseOD(_SharedStore, DenseOD):
+    backend = 'shared_dense'
+
+    # Dense slice views onto one mapped (96, n, n) array
+    def _views(self, path):
+        self.dense = np.load(os.path.join(path, 'dense.npy'), mmap_mode='r')
+        return {(day, hour): self.dense[d * HOURS + hour] for d, day in enumerate(day_types) for hour in range(HOURS)}
+
+
+def attach_shared(path):
+    with open(os.path.join(path, 'meta.json'), 'r') as f:
+        backend = json.load(f).get('backend', 'sparse')
+    return SharedDenseOD(path) if backend == 'dense' else SharedOD(path)
+
+
+# Sync the OD cache, export it if this state has not been shared yet, and attach
+def open_shared(data_dir='.', cache_dir=CACHE_DIR, shared_dir=SHARED_DIR, geo_path="MAP.json", weekday_weight=1.0,
+                backend='auto', fill_ratio=DENSE_FILL_RATIO):
+    with cache_lock(cache_dir):
+        cache = open_cache(data_dir, cache_dir, geo_path, weekday_weight)
+        path = export_shared(cache, shared_dir, backend, fill_ratio)
+    return attach_shared(path)
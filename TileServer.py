@@ -0,0 +1,261 @@
+# Local XYZ tile server for the hourly region intensity maps.
+# Serves 256 x 256 PNG tiles of origin / destination / combined trips per
+# region for any day type and hour at
+#     http://localhost:8000/{day}/{hour}/{measure}/{z}/{x}/{y}.png
+# so any web map client (Leaflet, OpenLayers, QGIS XYZ layers) can show them
+# over its own basemap. GET / returns a TileJSON description.
+#
+# Tiles are drawn straight from the shared marginals and the grid: the MAP.json
+# regions are a regular lon/lat grid, so a tile's pixel columns map to grid
+# columns and its pixel rows to grid rows, and a tile is one gather from the
+# (optionally k-ring smoothed) region raster through a colour table. Colours
+# are scaled to the busiest region of the hour, so tiles of one map agree at
+# every zoom level. The PNG encoder is zlib only.
+#
+# Rendered tiles are kept under od_cache/tiles/, in a folder per data state
+# and style, and evicted least recently used once the whole tile cache is over
+# its size limit (which also clears out tiles of older data), so repeat views,
+# also after a restart, are a file read.
+#
+# Usage: python TileServer.py [--port 8000] [--cache-mb 256] [--smoothing 0] [--cmap magma_r]
+#        [--weekday-weight 1.0]
+
+import argparse
+import hashlib
+import json
+import os
+import re
+import struct
+import threading
+import zlib
+from collections import OrderedDict
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import numpy as np
+from matplotlib import colormaps
+from Grid import EARTH_RADIUS, mercator_to_lonlat
+from ODCache import CACHE_DIR
+from ODData import day_types, HOURS, measures
+from Raster import raster_extent_3857, region_raster, smooth_k_ring
+
+TILE_SIZE = 256
+MIN_ZOOM = 0
+MAX_ZOOM = 20
+ALPHA = 0.75
+CACHE_MB = 256
+WORLD = 2 * np.pi * EARTH_RADIUS        # EPSG:3857 width of the whole world
+
+tile_path = re.compile(r'^/(W|SAT|SUN|ALL)/(\d{1,2})/(origin|destination|combined)/(\d{1,2})/(\d+)/(\d+)\.png$')
+
+
+def _png_chunk(kind, data):
+    return struct.pack('>I', len(data)) + kind + data + struct.pack('>I', zlib.crc32(kind + data) & 0xffffffff)
+
+
+# (height, width, 4) uint8 RGBA array -> PNG bytes
+def encode_png(rgba, level=6):
+    height, width = rgba.shape[:2]
+    # Filter type 0 (none) in front of every row
+    rows = np.concatenate([np.zeros((height, 1), dtype=np.uint8), rgba.reshape(height, width * 4)], axis=1)
+    header = struct.pack('>IIBBBBB', width, height, 8, 6, 0, 0, 0)
+    return (b'\x89PNG\r\n\x1a\n' + _png_chunk(b'IHDR', header)
+            + _png_chunk(b'IDAT', zlib.compress(rows.tobytes(), level)) + _png_chunk(b'IEND', b''))
+
+
+# EPSG:3857 (left, right, bottom, top) of an XYZ tile
+def tile_bounds(z, x, y):
+    size = WORLD / 2 ** z
+    left = -WORLD / 2 + x * size
+    top = WORLD / 2 - y * size
+    return left, left + size, top - size, top
+
+
+class TileRenderer:
+    def __init__(self, od, smoothing=0, cmap='magma_r', alpha=ALPHA):
+        self.od = od
+        self.grid = od.grid
+        self.smoothing = smoothing
+        self.extent = raster_extent_3857(self.grid)
+        self.colors = (colormaps[cmap](np.linspace(0, 1, 256)) * 255).round().astype(np.uint8)
+        self.colors[:, 3] = round(alpha * 255)
+        self.rasters = {}             # {(day, hour, measure): raster scaled to 0..255, -1 outside}
+        self.lock = threading.Lock()
+        self.empty = encode_png(np.zeros((TILE_SIZE, TILE_SIZE, 4), dtype=np.uint8))
+
+    def _raster(self, day, hour, measure):
+        key = (day, hour, measure)
+        with self.lock:
+            if key not in self.rasters:
+                raster = smooth_k_ring(region_raster(self.grid, self.od.totals(day, hour, measure)), self.smoothing)
+                vmax = np.nanmax(raster) if np.isfinite(raster).any() else 0.0
+                scaled = np.clip(raster / max(vmax, 1e-9), 0, 1) * 255
+                self.rasters[key] = np.where(np.isnan(raster), -1, np.nan_to_num(scaled)).astype(np.int16)
+            return self.rasters[key]
+
+    def render(self, day, hour, measure, z, x, y):
+        left, right, bottom, top = tile_bounds(z, x, y)
+        grid_left, grid_right, grid_bottom, grid_top = self.extent
+        if right <= grid_left or left >= grid_right or top <= grid_bottom or bottom >= grid_top:
+            return self.empty
+
+        # Pixel centres -> grid columns (from x alone) and grid rows (from y alone)
+        step = (right - left) / TILE_SIZE
+        centres = (np.arange(TILE_SIZE) + 0.5) * step
+        lon, _ = mercator_to_lonlat(left + centres, 0.0)
+        _, lat = mercator_to_lonlat(0.0, top - centres)
+        cols = np.floor((lon - self.grid.lon0) / self.grid.dlon).astype(np.int64)
+        rows = np.floor((lat - self.grid.lat0) / self.grid.dlat).astype(np.int64)
+        col_ok = (cols >= 0) & (cols < self.grid.n_cols)
+        row_ok = (rows >= 0) & (rows < self.grid.n_rows)
+        if not col_ok.any() or not row_ok.any():
+            return self.empty
+
+        raster = self._raster(day, hour, measure)
+        levels = raster[np.where(row_ok, rows, 0)[:, None], np.where(col_ok, cols, 0)[None, :]]
+        levels[~(row_ok[:, None] & col_ok[None, :])] = -1
+        rgba = self.colors[np.maximum(levels, 0)]
+        rgba[levels < 0] = 0
+        return encode_png(rgba)
+
+
+class TileCache:
+    def __init__(self, path, max_bytes=CACHE_MB << 20):
+        self.path = path
+        self.max_bytes = max_bytes
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        # Least recently used first, seeded from file times so the order survives restarts
+        files = []
+        for folder, _, names in os.walk(path):
+            for name in names:
+                if name.endswith('.png'):
+                    full = os.path.join(folder, name)
+                    stat = os.stat(full)
+                    files.append((stat.st_mtime_ns, full, stat.st_size))
+        self.entries = OrderedDict((full, size) for _, full, size in sorted(files))
+        self.size = sum(self.entries.values())
+
+    def get(self, name):
+        full = os.path.join(self.path, name)
+        with self.lock:
+            if full not in self.entries:
+                self.misses += 1
+                return None
+            self.entries.move_to_end(full)
+            self.hits += 1
+        try:
+            with open(full, 'rb') as f:
+                data = f.read()
+            os.utime(full)
+            return data
+        except FileNotFoundError:
+            return None
+
+    def put(self, name, data):
+        full = os.path.join(self.path, name)
+        os.makedirs(os.path.dirname(full), exist_ok=True)
+        tmp = f"{full}.{threading.get_ident()}.tmp"
+        with open(tmp, 'wb') as f:
+            f.write(data)
+        os.replace(tmp, full)
+        with self.lock:
+            self.size += len(data) - self.entries.pop(full, 0)
+            self.entries[full] = len(data)
+            while self.size > self.max_bytes and len(self.entries) > 1:
+                old, size = self.entries.popitem(last=False)
+                self.size -= size
+                try:
+                    os.remove(old)
+                except FileNotFoundError:
+                    pass
+
+    def stats(self):
+        return {'tiles': len(self.entries), 'bytes': self.size, 'hits': self.hits, 'misses': self.misses}
+
+
+# Cache folder for one data state and tile style, so stale tiles are never served
+def style_key(od, smoothing, cmap, alpha):
+    state = json.dumps({'data': os.path.basename(os.path.normpath(od.path)), 'smoothing': smoothing,
+                        'cmap': cmap, 'alpha': alpha})
+    return hashlib.sha1(state.encode()).hexdigest()[:16]
+
+
+def tilejson(grid_extent, host):
+    left, right, bottom, top = grid_extent
+    (west, east), (south, north) = mercator_to_lonlat(np.array([left, right]), np.array([bottom, top]))
+    return {
+        'tilejson': '2.2.0',
+        'name': 'WorcesterOD region intensity',
+        'tiles': [f"http://{host}/{{day}}/{{hour}}/{{measure}}/{{z}}/{{x}}/{{y}}.png"],
+        'minzoom': MIN_ZOOM,
+        'maxzoom': MAX_ZOOM,
+        'bounds': [float(west), float(south), float(east), float(north)],
+        'day_types': day_types,
+        'hours': HOURS,
+        'measures': measures,
+    }
+
+
+def make_handler(renderer, cache, style):
+    class TileHandler(BaseHTTPRequestHandler):
+        def _send(self, status, body, content_type):
+            self.send_response(status)
+            self.send_header('Content-Type', content_type)
+            self.send_header('Content-Length', str(len(body)))
+            self.send_header('Access-Control-Allow-Origin', '*')
+            if status == 200 and content_type == 'image/png':
+                self.send_header('Cache-Control', 'max-age=3600')
+            self.end_headers()
+            self.wfile.write(body)
+
+        def do_GET(self):
+            path = self.path.split('?', 1)[0]
+            if path in ('/', '/tiles.json'):
+                body = dict(tilejson(renderer.extent, self.headers.get('Host', 'localhost')), cache=cache.stats())
+                self._send(200, json.dumps(body, indent=1).encode(), 'application/json')
+                return
+            match = tile_path.match(path)
+            if not match:
+                self._send(404, b'Not found', 'text/plain')
+                return
+            day, hour, measure, z, x, y = match.groups()
+            hour, z, x, y = int(hour), int(z), int(x), int(y)
+            if hour >= HOURS or not MIN_ZOOM <= z <= MAX_ZOOM or x >= 2 ** z or y >= 2 ** z:
+                self._send(404, b'Not found', 'text/plain')
+                return
+            name = os.path.join(style, day, str(hour), measure, str(z), str(x), f"{y}.png")
+            data = cache.get(name)
+            if data is None:
+                data = renderer.render(day, hour, measure, z, x, y)
+                cache.put(name, data)
+            self._send(200, data, 'image/png')
+
+        def log_message(self, format, *args):
+            pass
+
+    return TileHandler
+
+
+if __name__ == '__main__':
+    from SharedOD import open_shared
+
+    parser = argparse.ArgumentParser(description="Serve XYZ PNG tiles of hourly region intensity.")
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8000)
+    parser.add_argument('--cache-mb', type=int, default=CACHE_MB)
+    parser.add_argument('--smoothing', type=int, default=0, help="k-ring smoothing radius in cells")
+    parser.add_argument('--cmap', default='magma_r')
+    parser.add_argument('--weekday-weight', type=float, default=1.0)
+    args = parser.parse_args()
+
+    od = open_shared(weekday_weight=args.weekday_weight)
+    renderer = TileRenderer(od, args.smoothing, args.cmap)
+    cache = TileCache(os.path.join(CACHE_DIR, 'tiles'), args.cache_mb << 20)
+    style = style_key(od, args.smoothing, args.cmap, ALPHA)
+    server = ThreadingHTTPServer((args.host, args.port), make_handler(renderer, cache, style))
+    print(f"Serving tiles at http://{args.host}:{args.port}/{{day}}/{{hour}}/{{measure}}/{{z}}/{{x}}/{{y}}.png "
+          f"({cache.stats()['tiles']} cached)")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
@@ -0,0 +1,182 @@
+# Zonal aggregation of the OD slices to any polygon layer (neighbourhoods,
+# wards, census tracts, ...). Each grid region is split between the zones it
+# overlaps by area, giving a sparse (n_regions, n_zones) overlay matrix W with
+#     W[i, z] = area(region i & zone z) / area(region i)
+# so trips are assumed to be spread evenly over a region. A zone-to-zone slice
+# is then W.T @ X @ W, two sparse products, and zone marginals are W.T @ x.
+# The geometry overlay runs once per (zone file, id field, grid) and is kept
+# under od_cache/, so later runs only load W.
+#
+# Zones are assumed not to overlap. Regions outside every zone drop out; the
+# overlay's coverage() reports how much of each region was assigned.
+#
+# Usage: python Zones.py zones.geojson [--id-field NAME] [--day W] [--hour 8] [--top 10]
+#        [--out zonal_flows.csv]
+
+import argparse
+import hashlib
+import json
+import os
+import numpy as np
+import scipy.sparse as sp
+import shapely
+from Grid import cell_bounds_3857
+from ODCache import CACHE_DIR, file_sha1
+from ODData import day_types, HOURS, as_count, top_indices
+
+# Overlaps below this share of a region are edge slivers from coordinate rounding
+MIN_FRACTION = 1e-4
+
+
+class ZoneOverlay:
+    def __init__(self, zone_ids, weights):
+        self.zone_ids = [str(z) for z in zone_ids]
+        self.weights = sp.csr_matrix(weights)      # (n_regions, n_zones) area fractions
+        self.weights_t = self.weights.T.tocsr()
+
+    @property
+    def n_zones(self):
+        return len(self.zone_ids)
+
+    # Share of each region's area that falls in some zone (1 for fully covered regions)
+    def coverage(self):
+        return np.asarray(self.weights.sum(axis=1)).ravel()
+
+    def aggregate(self, m):
+        return sp.csr_matrix(self.weights_t @ sp.csr_matrix(m) @ self.weights)
+
+    def aggregate_totals(self, values):
+        return self.weights_t @ np.asarray(values, dtype=np.float64)
+
+    def save(self, path):
+        tmp = f"{path}.tmp{os.getpid()}.npz"
+        np.savez(tmp, zone_ids=np.array(self.zone_ids), data=self.weights.data, indices=self.weights.indices,
+                 indptr=self.weights.indptr, shape=np.array(self.weights.shape))
+        os.replace(tmp, path)
+
+
+def load_overlay_file(path):
+    with np.load(path) as data:
+        weights = sp.csr_matrix((data['data'], data['indices'], data['indptr']), shape=tuple(data['shape']))
+        return ZoneOverlay(data['zone_ids'].tolist(), weights)
+
+
+def build_overlay(grid, zones, zone_ids):
+    cells = shapely.box(*cell_bounds_3857(grid).T)
+    zones = np.asarray(zones)
+    cell_idx, zone_idx = shapely.STRtree(zones).query(cells, predicate='intersects')
+    shared = shapely.area(shapely.intersection(cells[cell_idx], zones[zone_idx]))
+    fractions = shared / shapely.area(cells)[cell_idx]
+    keep = fractions >= MIN_FRACTION
+    weights = sp.csr_matrix((fractions[keep], (cell_idx[keep], zone_idx[keep])),
+                            shape=(grid.n_regions, len(zones)))
+    return ZoneOverlay(zone_ids, weights)
+
+
+def read_zones(zones_path, id_field=None):
+    import geopandas as gpd
+    zones = gpd.read_file(zones_path)
+    if zones.crs is None:
+        zones = zones.set_crs(epsg=4326)
+    zones = zones[zones.geometry.notna()].to_crs(epsg=3857)
+    ids = zones[id_field] if id_field else zones.index
+    return zones.geometry.values, list(ids)
+
+
+def overlay_key(zones_path, grid, id_field=None):
+    state = json.dumps({'zones': file_sha1(zones_path), 'id_field': id_field,
+                        'grid': [grid.lon0, grid.lat0, grid.dlon, grid.dlat, grid.labels.tolist()]})
+    return hashlib.sha1(state.encode()).hexdigest()[:16]
+
+
+# Overlay for a zone file, built once and then loaded from the cache folder
+def load_overlay(zones_path, grid, id_field=None, cache_dir=CACHE_DIR):
+    path = os.path.join(cache_dir, f"zones_{overlay_key(zones_path, grid, id_field)}.npz")
+    if os.path.exists(path):
+        return load_overlay_file(path)
+    overlay = build_overlay(grid, *read_zones(zones_path, id_field))
+    os.makedirs(cache_dir, exist_ok=True)
+    overlay.save(path)
+    return overlay
+
+
+class ZonalOD:
+    def __init__(self, od, overlay):
+        self.od = od
+        self.overlay = overlay
+        self._matrices = {}           # {(day, hour): zone-to-zone matrix}, built on first use
+
+    @property
+    def zone_ids(self):
+        return self.overlay.zone_ids
+
+    def matrix(self, day, hour):
+        if (day, hour) not in self._matrices:
+            self._matrices[(day, hour)] = self.overlay.aggregate(self.od.matrix(day, hour))
+        return self._matrices[(day, hour)]
+
+    def delta(self, day, hour):
+        return self.matrix(day, hour) - self.matrix(day, (hour + 1) % HOURS)
+
+    def totals(self, day, hour, measure='origin', change=False):
+        return self.overlay.aggregate_totals(self.od.totals(day, hour, measure, change))
+
+    # Top-K zones as [(zone id, trips)]
+    def top_zones(self, day, hour, k, measure='origin', change=False):
+        values = self.totals(day, hour, measure, change)
+        return [(self.zone_ids[i], as_count(round(values[i], 2))) for i in top_indices(values, k)]
+
+    # Top-K zone pairs as [((origin zone, destination zone), trips)]
+    def top_pairs(self, day, hour, k, internal=True, change=False):
+        m = (self.delta(day, hour) if change else self.matrix(day, hour)).tocoo()
+        origins, dests, values = m.row, m.col, m.data
+        if not internal:
+            keep = origins != dests
+            origins, dests, values = origins[keep], dests[keep], values[keep]
+        ids = self.zone_ids
+        return [((ids[origins[i]], ids[dests[i]]), as_count(round(values[i], 2))) for i in top_indices(values, k)]
+
+    # Long table of every non-zero zone pair in every slice
+    def flow_table(self, days=day_types):
+        import pandas as pd
+        ids = np.array(self.zone_ids, dtype=object)
+        frames = []
+        for day in days:
+            for hour in range(HOURS):
+                m = self.matrix(day, hour).tocoo()
+                frames.append(pd.DataFrame({'day': day, 'hour': hour, 'origin': ids[m.row],
+                                            'destination': ids[m.col], 'trips': m.data}))
+        return pd.concat(frames, ignore_index=True)
+
+
+if __name__ == '__main__':
+    from SharedOD import open_shared
+
+    parser = argparse.ArgumentParser(description="Aggregate the OD slices to the zones of a polygon layer.")
+    parser.add_argument('zones')
+    parser.add_argument('--id-field', default=None, help="Zone attribute to label zones by (default: feature index)")
+    parser.add_argument('--day', choices=day_types, default='W')
+    parser.add_argument('--hour', type=int, default=8)
+    parser.add_argument('--top', type=int, default=10)
+    parser.add_argument('--out', default=None, help="Write every zone pair of every slice to this CSV")
+    args = parser.parse_args()
+
+    od = open_shared()
+    overlay = load_overlay(args.zones, od.grid, args.id_field)
+    zonal = ZonalOD(od, overlay)
+
+    coverage = overlay.coverage()
+    print(f"{overlay.n_zones} zones; {int((coverage > 0).sum())} of {len(coverage)} regions overlap a zone, "
+          f"{float(coverage.mean()):.1%} of the grid area is covered")
+    print(f"Top {args.top} zone pairs for {args.day}, Hour {args.hour:02d}:00:")
+    for (origin, dest), trips in zonal.top_pairs(args.day, args.hour, args.top):
+        print(f"  {origin} -> {dest}: {trips}")
+    for measure in ['origin', 'destination']:
+        print(f"Top {args.top} zones by {measure}:")
+        for zone, trips in zonal.top_zones(args.day, args.hour, args.top, measure):
+            print(f"  {zone}: {trips}")
+
+    if args.out:
+        table = zonal.flow_table()
+        table.to_csv(args.out, index=False)
+        print(f"Wrote {len(table)} rows to {args.out}")